@@ -0,0 +1,474 @@
+
+import random
+import inspect
+import multiprocessing
+import numpy as np
+import feedback as fb
+
+# Batched versions of the components in feedback.py: all state is held in
+# NumPy arrays of shape (n,), one entry per replica, so that a single call
+# to work() advances every replica by one step. Gains and other parameters
+# may be scalars or arrays of shape (n,).
+
+# ============================================================
+# Components
+
+class Component( fb.Component ):
+    def work( self, u ):
+        return u
+
+def _state( n, value=0.0 ):
+    return np.zeros( n ) + value
+
+# ============================================================
+# Controllers
+
+# --- PID Controllers
+
+class PidController( Component ):
+    def __init__( self, kp, ki, kd=0, n=1 ):
+        self.kp, self.ki, self.kd = kp, ki, kd
+        self.i = _state( n )
+        self.d = _state( n )
+        self.prev = _state( n )
+
+    def work( self, e ):
+        self.i += self.dt*e
+        self.d = ( e - self.prev )/self.dt
+        self.prev = e
+
+        return self.kp*e + self.ki*self.i + self.kd*self.d
+
+class AdvController( Component ):
+    def __init__( self, kp, ki, kd=0, clamp=(-1e10,1e10), smooth=1, n=1 ):
+        self.kp, self.ki, self.kd = kp, ki, kd
+        self.i = _state( n )
+        self.d = _state( n )
+        self.prev = _state( n )
+
+        self.unclamped = np.ones( n, dtype=bool )
+        self.clamp_lo, self.clamp_hi = clamp
+
+        self.alpha = smooth
+
+    def work( self, e ):
+        self.i += self.dt*e*self.unclamped
+
+        self.d = self.alpha*(e - self.prev)/self.dt + (1.0-self.alpha)*self.d
+
+        u = self.kp*e + self.ki*self.i + self.kd*self.d
+
+        self.unclamped = ( self.clamp_lo < u ) & ( u < self.clamp_hi )
+        self.prev = e
+
+        return u
+
+# --- Bank of independent controllers
+
+class PidBank( Component ):
+    # Many independent controllers with the behavior of AdvController
+    # (derivative smoothing, integrator clamping), stored as contiguous
+    # arrays. Controllers are added and removed by handle; the error vector
+    # passed to work() is in slot order (see slots()). Removal moves the
+    # last controller into the freed slot.
+
+    PARAMS = ( 'kp', 'ki', 'kd', 'alpha', 'lo', 'hi' )
+    STATE = ( 'i', 'd', 'prev' )
+
+    def __init__( self, capacity=16, dtype=np.float64 ):
+        self.dtype = np.dtype( dtype ).type
+        self.n = 0                    # number of controllers in the bank
+
+        for f in self.PARAMS + self.STATE:
+            setattr( self, '_'+f, np.zeros( capacity, dtype ) )
+        self._unclamped = np.ones( capacity, dtype=bool )
+        self._handle = np.zeros( capacity, dtype=np.int64 ) # slot -> handle
+
+        self.slot = {}                # handle -> slot
+        self.next_handle = 0
+
+    def add( self, kp, ki, kd=0, clamp=(-1e10,1e10), smooth=1 ):
+        # Parameters may be arrays, to add many controllers at once
+        values = np.broadcast_arrays( kp, ki, kd, smooth, clamp[0], clamp[1] )
+        m = values[0].size
+        self._reserve( self.n + m )
+
+        lo, hi = self.n, self.n + m
+        for f, v in zip( ( 'kp', 'ki', 'kd', 'alpha', 'lo', 'hi' ), values ):
+            getattr( self, '_'+f )[lo:hi] = v.ravel()
+        for f in self.STATE:
+            getattr( self, '_'+f )[lo:hi] = 0
+        self._unclamped[lo:hi] = True
+
+        handles = np.arange( self.next_handle, self.next_handle + m )
+        self._handle[lo:hi] = handles
+        for k, h in enumerate( handles ):
+            self.slot[h] = lo + k
+
+        self.n += m
+        self.next_handle += m
+
+        if np.ndim( kp ) == 0 and m == 1:
+            return handles[0]
+        return handles
+
+    def remove( self, handle ):
+        k = self.slot.pop( handle )
+        last = self.n - 1
+
+        if k != last:                 # move last controller into slot k
+            for f in self.PARAMS + self.STATE + ( 'unclamped', 'handle' ):
+                a = getattr( self, '_'+f )
+                a[k] = a[last]
+            self.slot[ self._handle[k] ] = k
+
+        self.n -= 1
+
+    def slots( self ):
+        return self._handle[:self.n] # handle of the controller in each slot
+
+    def _reserve( self, m ):
+        capacity = len( self._kp )
+        if m <= capacity:
+            return
+
+        capacity = max( m, 2*capacity )
+        for f in self.PARAMS + self.STATE + ( 'unclamped', 'handle' ):
+            a = getattr( self, '_'+f )
+            b = np.zeros( capacity, a.dtype )
+            b[:self.n] = a[:self.n]
+            setattr( self, '_'+f, b )
+
+    def work( self, e ):
+        m = self.n
+        e = np.asarray( e, dtype=self.dtype )
+        i, d, prev = self._i[:m], self._d[:m], self._prev[:m]
+        unclamped = self._unclamped[:m]
+        alpha = self._alpha[:m]
+
+        if self.dt is None:           # as the scalar controllers would
+            raise TypeError( "No sampling interval: set fb.DT, call "
+                             "bind( dt ), or pass dt to the loop function" )
+        dt = self.dtype( self.dt )
+        i += dt*e*unclamped           # in-place: updates the bank
+
+        d *= 1 - alpha
+        d += alpha*( e - prev )/dt
+
+        u = self._kp[:m]*e + self._ki[:m]*i + self._kd[:m]*d
+
+        unclamped[:] = ( self._lo[:m] < u ) & ( u < self._hi[:m] )
+        prev[:] = e
+
+        return u
+
+# --- Relay and Band Controllers
+
+class DeadbandController( Component ):
+    def __init__( self, zone ):
+        self.zone = zone
+
+    def work( self, e ):
+        return np.where( np.abs(e) > self.zone, e - np.sign(e)*self.zone, 0.0 )
+
+class RelayController( Component ):
+    def work( self, e ):
+        return np.sign( e )
+
+class DeadbandRelayController( Component ):
+    def __init__( self, zone ):
+        self.zone = zone
+
+    def work( self, e ):
+        return np.where( np.abs(e) > self.zone, np.sign(e), 0.0 )
+
+class HysteresisRelayController( Component ):
+    def __init__( self, zone, n=1 ):
+        self.zone = zone
+        self.prev = _state( n )
+
+    def work( self, e ):
+        rising = np.where( e < self.zone, 0.0, 1.0 )
+        falling = np.where( e > -self.zone, 0.0, -1.0 )
+
+        u = np.where( e > self.prev, rising, falling )
+
+        self.prev = e
+        return u
+
+# ============================================================
+# Simple Systems
+
+class Boiler( Component ):
+    def __init__( self, g=0.01, n=1 ):
+        self.y = _state( n )
+        self.g = g
+
+    def work( self, u ):
+        self.y = self.y + self.dt*( -self.g*self.y + u )
+        return self.y
+
+class Spring( Component ):
+    def __init__( self, m=0.1, k=1, g=0.05, n=1 ):
+        self.x = _state( n )
+        self.v = _state( n )
+
+        self.m = m
+        self.k = k
+        self.g = g
+
+    def work( self, u ):
+        a = ( - self.k*self.x - self.g*self.v + u )/self.m
+        self.v = self.v + self.dt*a
+        self.x = self.x + self.dt*self.v
+        return self.x
+
+# ============================================================
+# Filters and Actuators
+
+class Identity( Component ):
+    def work( self, x ): return x
+
+class Limiter( Component ):
+    def __init__( self, lo, hi ):
+        self.lo = lo
+        self.hi = hi
+
+    def work( self, x ):
+        return np.clip( x, self.lo, self.hi )
+
+class Discretizer( Component ):
+    def __init__( self, binwidth ):
+        self.binwidth = binwidth
+
+    def work( self, u ):
+        return self.binwidth*np.trunc( u/self.binwidth )
+
+class Hysteresis( Component ):
+    def __init__( self, threshold, n=1 ):
+        self.threshold = threshold
+        self.prev = _state( n )
+
+    def work( self, u ):
+        jump = np.abs( u - self.prev ) > self.threshold
+        self.prev = np.where( jump, u, self.prev )
+        return self.prev
+
+class Integrator( Component ):
+    def __init__( self, n=1 ):
+        self.data = _state( n )
+
+    def work( self, u ):
+        self.data = self.data + u
+        return self.dt*self.data
+
+class FixedFilter( Component ):
+    def __init__( self, n, replicas=1 ):
+        self.n = n
+        self.data = np.zeros( (n, replicas) ) # ring buffer, one column each
+        self.total = _state( replicas )
+        self.k = 0                            # number of samples seen
+
+    def work( self, x ):
+        slot = self.k % self.n
+        self.total += x - self.data[slot]
+        self.data[slot] = x
+        self.k += 1
+
+        if slot == self.n-1:                  # re-sum once per cycle
+            self.total = self.data.sum( axis=0 )
+
+        return self.total/min( self.k, self.n )
+
+class RecursiveFilter( Component ):
+    def __init__( self, alpha, n=1 ):
+        self.alpha = alpha
+        self.y = _state( n )
+
+    def work( self, x ):
+        self.y = self.alpha*x + (1-self.alpha)*self.y
+        return self.y
+
+# --- Adapter for scalar components that have no batched version
+
+class Replicated( Component ):
+    def __init__( self, ctor, ctor_args, n ):
+        self.replicas = [ ctor( *ctor_args ) for _ in range( n ) ]
+
+    def work( self, u ):
+        u = np.broadcast_to( u, (len(self.replicas),) )
+        return np.array( [ p.work(x) for p, x in zip( self.replicas, u ) ],
+                         dtype=float )
+
+# ============================================================
+# Trajectories
+
+class Trajectory:
+    # Per-replica trajectories: one array of shape (tm, n) per channel
+
+    def __init__( self, tm, n, channels, dt=None ):
+        self.t = np.arange( tm )
+        self.time = self.t*( fb.DT if dt is None else dt )
+        self.channels = channels
+
+        for c in channels:
+            setattr( self, c, np.zeros( (tm, n) ) )
+
+    def record( self, t, **values ):
+        for c in self.channels:
+            getattr( self, c )[t] = values[c]
+
+    def mean( self, channel ):
+        return getattr( self, channel ).mean( axis=1 )
+
+    def std( self, channel ):
+        return getattr( self, channel ).std( axis=1 )
+
+    def bands( self, channel, lo=5, hi=95 ):
+        # Percentile bands across replicas: (lower, median, upper) per step
+        lower, median, upper = np.percentile( getattr( self, channel ),
+                                              [ lo, 50, hi ], axis=1 )
+        return lower, median, upper
+
+    def print_bands( self, channel='y', lo=5, hi=95 ):
+        lower, median, upper = self.bands( channel, lo, hi )
+        mean = self.mean( channel )
+
+        for t in self.t:
+            print t, self.time[t], lower[t], median[t], upper[t], mean[t]
+
+# ============================================================
+# Loop functions
+
+CHANNELS = ( 'r', 'e', 'u', 'v', 'y', 'z' )
+
+def step_response( setpoint, plant, n, tm=5000, channels=CHANNELS,
+                   dt=None ):
+    dt = fb.bind( dt, [ plant ] )
+    traj = Trajectory( tm, n, channels, dt )
+
+    for t in range( tm ):
+        r = setpoint(t)
+        u = r
+        y = plant.work( u )
+
+        traj.record( t, r=r, e=0, u=u, v=u, y=y, z=y )
+
+    return traj
+
+def open_loop( setpoint, controller, plant, n, tm=5000, channels=CHANNELS,
+               dt=None ):
+    dt = fb.bind( dt, [ controller, plant ] )
+    traj = Trajectory( tm, n, channels, dt )
+
+    for t in range( tm ):
+        r = setpoint(t)
+        u = controller.work( r )
+        y = plant.work( u )
+
+        traj.record( t, r=r, e=0, u=u, v=u, y=y, z=y )
+
+    return traj
+
+def closed_loop( setpoint, controller, plant, n, tm=5000, inverted=False,
+                 actuator=Identity(), returnfilter=Identity(),
+                 channels=CHANNELS, dt=None ):
+    dt = fb.bind( dt, [ controller, actuator, plant, returnfilter ] )
+    traj = Trajectory( tm, n, channels, dt )
+
+    z = _state( n )
+    for t in range( tm ):
+        r = setpoint(t)
+        e = r - z
+        if inverted == True: e = -e
+        u = controller.work(e)
+        v = actuator.work(u)
+        y = plant.work(v)
+        z = returnfilter.work(y)
+
+        traj.record( t, r=r, e=e, u=u, v=v, y=y, z=z )
+
+    return traj
+
+# --- Static process characteristic
+
+def static_test( plant_ctor, ctor_args, umax, steps, repeats, tmax,
+                 processes=None, seed=None, dt=None ):
+    # Same experiment as fb.static_test(), but all steps*repeats runs side
+    # by side. Returns arrays: u, mean of y, and standard deviation of y.
+
+    u = np.arange( steps )*float(umax)/float(steps)
+
+    if _batched( plant_ctor ):   # one array simulation of all runs
+        if seed is not None:     # for plants that draw from the modules
+            random.seed( seed ); np.random.seed( seed )
+
+        us = np.repeat( u, repeats )
+        p = _construct( plant_ctor, ctor_args, len(us), seed )
+        fb.bind( dt, [ p ] )
+
+        for t in range( tmax ):
+            y = p.work( us )
+
+        y = np.asarray( y, dtype=float ).reshape( steps, repeats )
+
+    else:                        # scalar plant: one run per task in a pool
+        global _static_task
+        _static_task = ( plant_ctor, ctor_args, u, repeats, tmax, seed, dt )
+
+        pool = multiprocessing.Pool( processes ) # fork: task is inherited
+        try:
+            y = pool.map( _static_run, range( steps*repeats ), chunksize=8 )
+        finally:
+            pool.terminate()
+            _static_task = None
+
+        y = np.array( y ).reshape( steps, repeats )
+
+    return u, y.mean( axis=1 ), y.std( axis=1 )
+
+def print_static( u, mean, std ):
+    for x, y, s in zip( u, mean, std ):
+        print x, y, s
+
+def _batched( ctor ):
+    return inspect.isclass( ctor ) and issubclass( ctor, Component )
+
+def _construct( ctor, ctor_args, n, seed=None ):
+    # Passes n, and seed (if given), to constructors that take them
+    args = inspect.getargspec( ctor.__init__ ).args
+    kwargs = {}
+    if 'n' in args: kwargs['n'] = n
+    if 'seed' in args and seed is not None: kwargs['seed'] = seed
+    return ctor( *ctor_args, **kwargs )
+
+_static_task = None
+
+def _static_run( k ):
+    plant_ctor, ctor_args, u, repeats, tmax, seed, dt = _static_task
+
+    if seed is None:             # forked workers must not share RNG state
+        random.seed(); np.random.seed()
+    else:
+        random.seed( seed*1000003 + k ); np.random.seed( [ seed, k ] )
+
+    p = apply( plant_ctor, ctor_args )
+    fb.bind( dt, [ p ] )
+    for t in range( tmax ):
+        y = p.work( u[k//repeats] )
+    return y
+
+# ============================================================
+
+if __name__ == '__main__':
+
+    fb.DT = 1
+
+    def setpoint( t ):
+        return 10*fb.double_step( t, 1000, 6000 )
+
+    n = 100
+    p = Boiler( g=np.random.uniform( 0.005, 0.015, n ), n=n )
+    c = PidController( 0.45, 0.01, n=n )
+
+    closed_loop( setpoint, c, p, n, 15000 ).print_bands( 'y' )
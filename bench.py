@@ -0,0 +1,180 @@
+
+import os
+import gc
+import sys
+import imp
+import json
+import time
+import random
+import argparse
+import resource
+import multiprocessing
+import feedback as fb
+
+# Benchmark suite: runs the case study scenarios headless (they are passed
+# a counting sink to write to, instead of stdout), with fixed seeds, each
+# in its own process. Reports steps/sec, peak memory, and the growth
+# in objects tracked by the garbage collector (plus allocated memory
+# blocks, where the interpreter exposes them). Results can be saved as a
+# JSON baseline, and compared against one to flag regressions.
+#
+#   python bench.py --save baseline.json
+#   python bench.py --compare baseline.json --threshold 0.1
+
+HERE = os.path.dirname( os.path.abspath( __file__ ) )
+
+# name: (file, function, arguments, dt)
+SCENARIOS = [
+    ( 'ch13-closedloop_jumps', 'ch13-cache.py', 'closedloop_jumps', (), 1 ),
+    ( 'ch14-closedloop', 'ch14-adserving.py', 'closedloop', (0.5, 0.25), 1 ),
+    ( 'ch15-closedloop1', 'ch15-ch16-serverpool-and-queue.py',
+      'closedloop1', (), 1 ),
+    ( 'ch15-closedloop2', 'ch15-ch16-serverpool-and-queue.py',
+      'closedloop2', (), 1 ),
+    ( 'ch15-closedloop3', 'ch15-ch16-serverpool-and-queue.py',
+      'closedloop3', (), 1 ),
+    ( 'ch15-nestedloops', 'ch15-ch16-serverpool-and-queue.py',
+      'nestedloops', (), 1 ),
+    ( 'ch17-production', 'ch17-fancontrol.py', 'production', (), 0.01 ),
+    ( 'ch18-closedloop', 'ch18-gameengine.py', 'closedloop', (), 1 ) ]
+
+class CountingSink( fb.NullSink ):
+    def __init__( self ):
+        self.steps = 0
+
+    def write( self, rec ):
+        self.steps += 1
+
+def _load( filename ):
+    name = os.path.splitext( filename )[0].replace( '-', '_' )
+    return imp.load_source( name, os.path.join( HERE, filename ) )
+
+def _allocated_blocks():
+    if hasattr( sys, 'getallocatedblocks' ):
+        return sys.getallocatedblocks()
+    return None
+
+def run( scenario, seed, sink=None ):
+    # Runs one scenario in the current process, writing to sink (a new
+    # CountingSink if None); returns its measurements
+    name, filename, function, args, dt = scenario
+    if sink is None: sink = CountingSink()
+
+    module = _load( filename )
+
+    random.seed( seed )
+    try:
+        import numpy
+        numpy.random.seed( seed )
+    except ImportError:
+        pass
+
+    gc.collect()
+    objects = len( gc.get_objects() )
+    blocks = _allocated_blocks()
+
+    start = time.time()
+    try:
+        getattr( module, function )( *args, dt=dt, sink=sink )
+    except SystemExit:                # the loop functions quit() when done
+        pass
+    elapsed = time.time() - start
+
+    result = { 'steps': sink.steps,
+               'seconds': elapsed,
+               'steps_per_sec': sink.steps/elapsed,
+               'peak_rss_kb': resource.getrusage( resource.RUSAGE_SELF ).ru_maxrss,
+               'objects': len( gc.get_objects() ) - objects }
+    if blocks is not None:
+        result['allocated_blocks'] = _allocated_blocks() - blocks
+    return result
+
+def _child( scenario, seed, sink, conn ):
+    try:
+        conn.send( run( scenario, seed, sink() ) )
+    except Exception, e:
+        conn.send( { 'error': "%s: %s" % ( e.__class__.__name__, e ) } )
+    conn.close()
+
+def run_isolated( scenario, seed, sink=CountingSink ):
+    # Separate process per scenario, so that peak memory is its own. sink:
+    # class (or factory) of the counting sink, made in that process
+    parent, child = multiprocessing.Pipe()
+    p = multiprocessing.Process( target=_child,
+                                 args=( scenario, seed, sink, child ) )
+    p.start()
+    child.close()       # else recv() waits forever if the child dies
+
+    try:
+        result = parent.recv()
+    except EOFError:
+        p.join()
+        result = { 'error': "exit code %s" % p.exitcode }
+    p.join()
+
+    if 'error' in result:
+        raise RuntimeError( "Scenario %s failed: %s" % ( scenario[0],
+                                                         result['error'] ) )
+    return result
+
+def suite( names=None, seed=1, repeat=3 ):
+    results = {}
+    for scenario in SCENARIOS:
+        if names and scenario[0] not in names:
+            continue
+
+        runs = [ run_isolated( scenario, seed ) for _ in range( repeat ) ]
+        results[ scenario[0] ] = max( runs, key=lambda r: r['steps_per_sec'] )
+    return results
+
+def report( results, baseline=None, threshold=0.1 ):
+    # Returns the names of scenarios that regressed against the baseline:
+    # slower, or more memory, by more than the threshold (a fraction)
+    regressions = []
+
+    print "# scenario steps steps/sec peak_rss_kb objects change flag"
+    for name, _, _, _, _ in SCENARIOS:
+        if name not in results:
+            continue
+        r = results[name]
+
+        change, flag = "-", ""
+        if baseline and name in baseline:
+            b = baseline[name]
+            speed = r['steps_per_sec']/b['steps_per_sec'] - 1
+            memory = float( r['peak_rss_kb'] )/b['peak_rss_kb'] - 1
+            change = "%+.1f%%" % ( 100*speed )
+
+            if speed < -threshold or memory > threshold:
+                flag = "REGRESSION"
+                regressions.append( name )
+
+        print name, r['steps'], int( r['steps_per_sec'] ), r['peak_rss_kb'],
+        print r['objects'], change, flag
+
+    return regressions
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument( 'scenarios', nargs='*' )
+    parser.add_argument( '--seed', type=int, default=1 )
+    parser.add_argument( '--repeat', type=int, default=3 )
+    parser.add_argument( '--save', metavar='FILE' )
+    parser.add_argument( '--compare', metavar='FILE' )
+    parser.add_argument( '--threshold', type=float, default=0.1 )
+    opts = parser.parse_args()
+
+    results = suite( opts.scenarios, opts.seed, opts.repeat )
+
+    baseline = None
+    if opts.compare:
+        baseline = json.load( open( opts.compare ) )
+
+    regressions = report( results, baseline, opts.threshold )
+
+    if opts.save:
+        json.dump( results, open( opts.save, 'w' ), indent=2, sort_keys=True )
+
+    if regressions:
+        sys.exit( 1 )
@@ -1,5 +1,12 @@
 
+import os
+import mmap
+import time
+import struct
 import random
+import heapq
+import hashlib
+from collections import deque
 import feedback as fb
 
 class Cache( fb.Component ):
@@ -9,6 +16,9 @@ class Cache( fb.Component ):
         self.size = size  # size limit of cache
         self.cache = {}   # actual cache: cache[key] = last_accessed_time
 
+        self.log = deque() # access log: (time, key), oldest first; entries
+                           # are stale if the key was accessed again later
+
         self.demand = demand # demand function
 
     def work( self, u ):
@@ -20,24 +30,24 @@ class Cache( fb.Component ):
 
         if i in self.cache:
             self.cache[i] = self.t   # update last access time
+            self._log( i )
             return 1
 
-        if len(self.cache) >= self.size: # must make room
-            m = 1 + len(self.cache) - self.size # number of elements to delete
-
-            tmp = {}
-            for k in self.cache.keys():    # key by last_access_time
-                tmp[ self.cache[k] ] = k
-                
-            for t in sorted( tmp.keys() ): # delete the oldest elements
-                del self.cache[ tmp[t] ]
-                m -= 1
-                if m == 0:
-                    break
+        while self.cache and len(self.cache) >= self.size: # must make room
+            t, k = self.log.popleft()
+            if self.cache[k] == t:   # oldest live entry: delete it
+                del self.cache[k]
 
         self.cache[i] = self.t       # insert into cache
+        self._log( i )
         return 0
 
+    def _log( self, i ):
+        self.log.append( (self.t, i) )
+
+        if len(self.log) > 2*len(self.cache) + 100: # drop stale entries
+            self.log = deque( e for e in self.log if self.cache[e[1]] == e[0] )
+
 
 class SmoothedCache( Cache ):
     def __init__( self, size, demand, avg ):
@@ -49,29 +59,441 @@ class SmoothedCache( Cache ):
         return self.f.work(y)
 
 # ============================================================
+# Other eviction policies: same interface as Cache ( size, demand ),
+# work() returns 1 for a hit, 0 for a miss. As in Cache, the size is set
+# on every step, and enforced (by evictions) when an item is inserted;
+# each eviction takes constant (amortized) time (LfuCache: logarithmic,
+# when it empties the bucket of least frequently used keys).
+
+class _Lru:
+    # Keys in order of their last push, oldest first: dict of key -> stamp,
+    # plus a log of (stamp, key) with lazy deletion, as in Cache
+
+    def __init__( self ):
+        self.keys = {}
+        self.log = deque()
+        self.t = 0
+
+    def __len__( self ):
+        return len( self.keys )
+
+    def __contains__( self, k ):
+        return k in self.keys
+
+    def push( self, k ):         # insert k, or move it to the newest end
+        self.t += 1
+        self.keys[k] = self.t
+        self.log.append( (self.t, k) )
+
+        if len(self.log) > 2*len(self.keys) + 100: # drop stale entries
+            self.log = deque( e for e in self.log
+                              if self.keys.get( e[1] ) == e[0] )
+
+    def remove( self, k ):
+        del self.keys[k]
+
+    def pop( self ):             # remove and return the oldest key
+        while True:
+            t, k = self.log.popleft()
+            if self.keys.get( k ) == t:
+                del self.keys[k]
+                return k
+
+class LfuCache( fb.Component ):
+    # Least frequently used; least recently used among equally frequent
+    def __init__( self, size, demand ):
+        self.size = size
+        self.demand = demand
+        self.t = 0
+
+        self.freq = {}     # key -> number of accesses
+        self.buckets = {}  # number of accesses -> _Lru of keys (non-empty)
+        self.heap = []     # heap of the keys of buckets, with stale entries
+        self.min = 0       # smallest number of accesses in the cache
+
+    def _touch( self, i, f ):
+        bucket = self.buckets.get( f )
+        if bucket is None:
+            bucket = self.buckets[f] = _Lru()
+            heapq.heappush( self.heap, f )
+        bucket.push( i )
+        self.freq[i] = f
+
+    def _evict( self ):
+        bucket = self.buckets[ self.min ]
+        del self.freq[ bucket.pop() ]
+        if not bucket:
+            del self.buckets[ self.min ]
+
+            heap = self.heap   # next smallest: drop stale entries on top
+            while heap and heap[0] not in self.buckets:
+                heapq.heappop( heap )
+            if len(heap) > 2*len(self.buckets) + 100:
+                heap[:] = sorted( self.buckets )
+            self.min = heap[0] if heap else 0
+
+    def work( self, u ):
+        self.t += 1
+        self.size = max( 0, int(u) )
+
+        i = self.demand( self.t )
+
+        f = self.freq.get( i )
+        if f is not None:
+            bucket = self.buckets[f]
+            bucket.remove( i )
+            if not bucket:
+                del self.buckets[f]
+                if self.min == f: self.min = f + 1
+            self._touch( i, f + 1 )
+            return 1
+
+        while self.freq and len(self.freq) >= self.size:
+            self._evict()
+
+        self._touch( i, 1 )
+        self.min = 1
+        return 0
+
+class ClockCache( fb.Component ):
+    # CLOCK (second chance): the clock is a deque, with the hand at the
+    # left end; a referenced key gets its bit cleared and goes around again
+    def __init__( self, size, demand ):
+        self.size = size
+        self.demand = demand
+        self.t = 0
+
+        self.ref = {}       # key -> reference bit
+        self.clock = deque()
+
+    def work( self, u ):
+        self.t += 1
+        self.size = max( 0, int(u) )
+
+        i = self.demand( self.t )
+
+        if i in self.ref:
+            self.ref[i] = True
+            return 1
+
+        while self.ref and len(self.ref) >= self.size:
+            k = self.clock.popleft()
+            if self.ref[k]:
+                self.ref[k] = False
+                self.clock.append( k )
+            else:
+                del self.ref[k]
+
+        self.ref[i] = False
+        self.clock.append( i )
+        return 0
+
+class ArcCache( fb.Component ):
+    # Adaptive replacement cache (Megiddo and Modha): recent (t1) and
+    # frequent (t2) items, with ghost lists of their evicted keys (b1, b2)
+    # steering the target size p of t1
+    def __init__( self, size, demand ):
+        self.size = size
+        self.demand = demand
+        self.t = 0
+
+        self.t1, self.t2, self.b1, self.b2 = _Lru(), _Lru(), _Lru(), _Lru()
+        self.p = 0.0
+
+    def _replace( self, in_b2 ):
+        t1 = len(self.t1)
+        if t1 and ( t1 > self.p or ( in_b2 and t1 == self.p ) ):
+            self.b1.push( self.t1.pop() )
+        elif self.t2:
+            self.b2.push( self.t2.pop() )
+        else:
+            self.b1.push( self.t1.pop() )
+
+    def work( self, u ):
+        self.t += 1
+        self.size = max( 0, int(u) )
+        c = max( 1, self.size )  # Cache holds one item at size 0, too
+        self.p = min( self.p, c )
+
+        i = self.demand( self.t )
+
+        if i in self.t1:
+            self.t1.remove( i )
+            self.t2.push( i )
+            return 1
+        if i in self.t2:
+            self.t2.push( i )
+            return 1
+
+        if i in self.b1:
+            self.p = min( c, self.p + max( len(self.b2)/float(len(self.b1)), 1 ) )
+            self.b1.remove( i )
+            self._make_room( c, False )
+            self.t2.push( i )
+            return 0
+
+        if i in self.b2:
+            self.p = max( 0, self.p - max( len(self.b1)/float(len(self.b2)), 1 ) )
+            self.b2.remove( i )
+            self._make_room( c, True )
+            self.t2.push( i )
+            return 0
+
+        while len(self.t1) + len(self.b1) >= c and self.b1:
+            self.b1.pop()
+        while len(self.t1) >= c:   # t1 alone fills the cache: no ghost
+            self.t1.pop()
+        self._make_room( c, False )
+        self.t1.push( i )
+        return 0
+
+    def _make_room( self, c, in_b2 ):
+        while len(self.t1) + len(self.t2) >= c:
+            self._replace( in_b2 )
+
+        ghosts = len(self.b1) + len(self.b2)
+        while ghosts + len(self.t1) + len(self.t2) >= 2*c and ghosts:
+            if self.b2: self.b2.pop()
+            else: self.b1.pop()
+            ghosts -= 1
+
+class TwoQCache( fb.Component ):
+    # 2Q (Johnson and Shasha): new keys enter the FIFO a1in; keys evicted
+    # from it are remembered in the ghost FIFO a1out, and are promoted to
+    # the LRU am when requested again
+    def __init__( self, size, demand, kin=0.25, kout=0.5 ):
+        self.size = size
+        self.demand = demand
+        self.t = 0
+
+        self.kin, self.kout = kin, kout # fractions of the size
+        self.a1in, self.a1out, self.am = _Lru(), _Lru(), _Lru()
+
+    def _make_room( self, c ):
+        while len(self.a1in) + len(self.am) >= c:
+            if len(self.a1in) > self.kin*c or not self.am:
+                self.a1out.push( self.a1in.pop() )
+                while len(self.a1out) > self.kout*c:
+                    self.a1out.pop()
+            else:
+                self.am.pop()
+
+    def work( self, u ):
+        self.t += 1
+        self.size = max( 0, int(u) )
+        c = max( 1, self.size )
+
+        i = self.demand( self.t )
+
+        if i in self.am:
+            self.am.push( i )
+            return 1
+        if i in self.a1in:
+            return 1
+
+        self._make_room( c )
+        if i in self.a1out:
+            self.a1out.remove( i )
+            self.am.push( i )
+        else:
+            self.a1in.push( i )
+        return 0
+
+POLICIES = [ Cache, LfuCache, ClockCache, ArcCache, TwoQCache ]
+
+class Smoothed( fb.Component ):
+    # Any of the caches, with the hit rate smoothed as in SmoothedCache
+    def __init__( self, cache, avg ):
+        self.cache = cache
+        self.f = fb.FixedFilter( avg )
+
+    def work( self, u ):
+        return self.f.work( self.cache.work( u ) )
+
+# ============================================================
+# Recorded demand: replay of access logs
+
+KEY = struct.Struct( '<q' )   # trace files: one 64-bit integer per request
+
+class TraceDemand:
+    # Demand function that replays the keys of a trace file (see
+    # convert_trace()), one per call. The file is memory-mapped and keys
+    # are unpacked a chunk at a time, so traces can be much larger than
+    # memory. offset, length: window of the trace to replay (in keys,
+    # i.e. steps); with loop=True, the window repeats indefinitely.
+
+    def __init__( self, filename, offset=0, length=None, loop=False,
+                  chunk=65536 ):
+        self.filename = filename
+        self.loop = loop
+        self.chunk = chunk
+
+        n = os.path.getsize( filename )//KEY.size
+        self.start = min( offset, n )
+        self.end = n if length is None else min( n, self.start + length )
+
+        self._open( self.start )
+
+    def _open( self, pos ):
+        self.file = open( self.filename, 'rb' )
+        self.mm = None
+        if self.end > 0:         # empty files cannot be mapped
+            self.mm = mmap.mmap( self.file.fileno(), 0,
+                                 access=mmap.ACCESS_READ )
+        self.keys, self.i, self.pos = [], 0, pos
+
+    def _read( self ):
+        if self.pos >= self.end:
+            if not self.loop or self.start == self.end:
+                raise EOFError( "End of trace: %s" % self.filename )
+            self.pos = self.start
+
+        m = min( self.chunk, self.end - self.pos )
+        self.keys = struct.unpack_from( '<%dq' % m, self.mm,
+                                        self.pos*KEY.size )
+        self.i = 0
+        self.pos += m
+
+    def __call__( self, t=None ):
+        try:
+            k = self.keys[ self.i ]
+        except IndexError:
+            self._read()
+            k = self.keys[0]
+        self.i += 1
+        return k
+
+    def position( self ):
+        return self.pos - len(self.keys) + self.i # next key to replay
+
+    # Snapshots (fb.Checkpoint) keep the position, not the mapping; a
+    # restore in place closes the mapping it replaces
+    def __getstate__( self ):
+        state = self.__dict__.copy()
+        state['pos'] = self.position()
+        for k in [ 'file', 'mm', 'keys', 'i' ]:
+            del state[k]
+        return state
+
+    def __setstate__( self, state ):
+        self.close()
+        self.__dict__.update( state )
+        self._open( state['pos'] )
+
+    def close( self ):
+        if self.__dict__.get( 'mm' ) is not None: self.mm.close()
+        if 'file' in self.__dict__: self.file.close()
+        self.mm = None
+
+def convert_trace( infile, outfile, field=0, chunk=65536 ):
+    # Converts a text log, one request per line, into a trace file. The
+    # key is the given whitespace-separated field of each line: integers
+    # are kept, anything else is replaced by a 64-bit hash (first 8 bytes
+    # of its MD5). Returns the number of keys written.
+    out = open( outfile, 'wb' )
+    pack = struct.Struct( '<%dq' % chunk ).pack
+
+    keys, count = [], 0
+    for line in open( infile ):
+        fields = line.split()
+        if len(fields) <= field:
+            continue
+
+        key = fields[field]
+        try:
+            k = int( key )
+            if not -2**63 <= k < 2**63: raise ValueError
+        except ValueError:
+            k = KEY.unpack( hashlib.md5( key ).digest()[:8] )[0]
+        keys.append( k )
+
+        if len(keys) == chunk:
+            out.write( pack( *keys ) )
+            count += chunk
+            keys = []
+
+    out.write( struct.pack( '<%dq' % len(keys), *keys ) )
+    out.close()
+    return count + len(keys)
+
+# ============================================================
+
+DT = 1 # Sampling interval of the scenarios
+
+# Scenarios take the sampling interval dt, the source of random numbers
+# rng (random module, or a fb.RandomStream such as RandomStream( 1 )),
+# and the sink for their output (stdout if None), so that they can also
+# run side by side, eg with fb.run_concurrently()
+
+def statictest( demand_width, dt=DT, rng=random, sink=None ):
+    def demand( t ):
+        return int( rng.gauss( 0, demand_width ) )
+
+    fb.static_test( SmoothedCache, (0, demand, 100), 150, 100, 5, 3000,
+                    dt=dt, sink=sink )
+
+def statictest_parallel( demand_width, dt=DT, rng=random ):
+    import batch as bt
 
-def statictest(demand_width):
     def demand( t ):
-        return int( random.gauss( 0, demand_width ) )
+        return int( rng.gauss( 0, demand_width ) )
 
-    fb.static_test( SmoothedCache, (0, demand, 100), 150, 100, 5, 3000 )
+    # No batched Cache: runs are spread over a process pool instead
+    u, mean, std = bt.static_test( SmoothedCache, (0, demand, 100),
+                                   150, 100, 5, 3000, dt=dt )
+    bt.print_static( u, mean, std )
     
 
-def stepresponse():
+def stepresponse( dt=DT, rng=random, sink=None ):
     def demand( t ): 
-        return int( random.gauss( 0, 15 ) )
+        return int( rng.gauss( 0, 15 ) )
 
     def setpoint( t ):
         return 40
 
     p = SmoothedCache( 0, demand, 100 )
 
-    fb.step_response( setpoint, p )
+    fb.step_response( setpoint, p, dt=dt, sink=sink )
+
 
+def identify( dt=DT, rng=random ):
+    # Model fitted to a recorded response to steps in cache size, and
+    # controller gains from the tuning rules
+    import ident
 
-def closedloop():
     def demand( t ): 
-        return int( random.gauss( 0, 15 ) )
+        return int( rng.gauss( 0, 15 ) )
+
+    def setpoint( t ):
+        return [ 10, 40, 20, 30 ][ (t//2000) % 4 ]
+
+    p = SmoothedCache( 0, demand, 100 )
+
+    u, y = ident.columns( fb.iter_step_response( setpoint, p, 16000, dt=dt ) )
+    model = ident.fopdt( u, y, dt, max_delay=500 )
+    ident.print_tuning( model, 'PI' )
+
+
+def autotune( dt=DT, rng=random ):
+    # Relay experiment around a cache size of 25 +/- 15
+    import ident
+
+    def demand( t ): 
+        return int( rng.gauss( 0, 15 ) )
+
+    p = SmoothedCache( 0, demand, 100 )
+
+    u = ident.relay_autotune( 0.7, p, d=15, bias=25, eps=0.03, tm=20000,
+                              tol=0.1, dt=dt )
+    print "# Ku Pu amplitude steps"
+    print u.Ku, u.Pu, u.amplitude, u.steps
+    print "# kp ki kd"
+    print "%f %f %f" % ident.ultimate_tuning( u, 'PI' )
+
+
+def closedloop( dt=DT, rng=random, sink=None ):
+    def demand( t ): 
+        return int( rng.gauss( 0, 15 ) )
     
     def setpoint( t ):
         if t > 5000:
@@ -81,17 +503,32 @@ def closedloop():
     p = SmoothedCache( 0, demand, 100 )
     c = fb.PidController( 100, 250 )
 
-    fb.closed_loop( setpoint, c, p, 10000 )
+    fb.closed_loop( setpoint, c, p, 10000, dt=dt, sink=sink )
+
+
+def closedloop_trace( filename, offset=0, tm=10000, dt=DT, sink=None ):
+    # Like closedloop(), with demand replayed from a trace file
+    def setpoint( t ):
+        return 0.7
+
+    demand = TraceDemand( filename, offset, tm )
+    p = SmoothedCache( 0, demand, 100 )
+    c = fb.PidController( 100, 250 )
+
+    try:
+        fb.closed_loop( setpoint, c, p, tm, dt=dt, sink=sink )
+    finally:
+        demand.close()
 
 
-def closedloop_jumps():
+def closedloop_jumps( dt=DT, rng=random, sink=None ):
     def demand( t ):
         if t < 3000:
-            return int( random.gauss( 0, 15 ) )
+            return int( rng.gauss( 0, 15 ) )
         elif t < 5000:
-            return int( random.gauss( 0, 35 ) )
+            return int( rng.gauss( 0, 35 ) )
         else:
-            return int( random.gauss( 100, 15 ) )
+            return int( rng.gauss( 100, 15 ) )
     
     def setpoint( t ):
         return 0.7
@@ -102,19 +539,175 @@ def closedloop_jumps():
 #   c = fb.PidController( 80, 2.0 )  # AMIGO - 3
 #   c = fb.PidController( 150, 2 )   # 4
 
-    fb.closed_loop( setpoint, c, p, 10000 )
+    fb.closed_loop( setpoint, c, p, 10000, dt=dt, sink=sink )
+
+
+def closedloop_profiled( dt=DT, rng=random ):
+    # Same as closedloop(), with time spent per component (and in the
+    # filter and demand function inside the cache)
+    import profiling
+
+    def demand( t ): 
+        return int( rng.gauss( 0, 15 ) )
+    
+    def setpoint( t ):
+        if t > 5000:
+            return 0.5
+        return 0.7
+
+    p = SmoothedCache( 0, demand, 100 )
+    c = fb.PidController( 100, 250 )
+
+    prof = profiling.closed_loop( setpoint, c, p, 100000,
+                                  sink=fb.FileSink( "/dev/null" ), dt=dt )
+    prof.report()
+    prof.collapsed( "closedloop.folded" )
+
+
+def closedloop_bands( n=100, dt=DT, rng=random ):
+    # Same as closedloop(), but for n replicas; controller is batched,
+    # caches are not (they are replicated)
+    import batch as bt
+
+    def demand( t ): 
+        return int( rng.gauss( 0, 15 ) )
+    
+    def setpoint( t ):
+        if t > 5000:
+            return 0.5
+        return 0.7
+
+    p = bt.Replicated( SmoothedCache, (0, demand, 100), n )
+    c = bt.PidController( 100, 250, n=n )
+
+    traj = bt.closed_loop( setpoint, c, p, n, 10000, channels=('u','y'),
+                           dt=dt )
+    traj.print_bands( 'y' )
+
+
+def benchmark():
+    # Requests/sec of the LRU Cache vs the original SortingCache, for
+    # identical request and size sequences; hit/miss results must match
+
+    def demand( t ):
+        return keys[t-1]
+
+    print "# size sorting_req/s lru_req/s hits identical"
+    for size in [ 10, 100, 1000, 10000 ]:
+        tm = 20000
+        rnd = random.Random( size )
+        keys = [ int( rnd.gauss( 0, size ) ) for _ in range( tm ) ]
+        sizes = [ size*rnd.uniform( 0.5, 1.0 ) for _ in range( tm ) ]
+
+        results, rates = [], []
+        for cls in [ SortingCache, Cache ]:
+            p = cls( 0, demand )
+
+            start = time.time()
+            results.append( [ p.work( u ) for u in sizes ] )
+            rates.append( tm/( time.time() - start ) )
+
+        print size, int(rates[0]), int(rates[1]), sum(results[1]),
+        print results[0] == results[1]
+
+
+def policies( tm=10000, dt=DT ):
+    # Eviction policies compared: requests/sec, and the closed loop of
+    # closedloop_jumps() (IAE, mean cache size over the last 2000 steps),
+    # with the same demand for all policies
+    import sweep
+
+    def setpoint( t ):
+        return 0.7
+
+    print "# policy req/s iae size"
+    for cls in POLICIES:
+        rng = fb.RandomStream( 1 )
+        def demand( t ):
+            if t < 3000:
+                return int( rng.gauss( 0, 15 ) )
+            elif t < 5000:
+                return int( rng.gauss( 0, 35 ) )
+            else:
+                return int( rng.gauss( 100, 15 ) )
+
+        p = Smoothed( cls( 0, demand ), 100 )
+        c = fb.PidController( 270, 7.5 )
+
+        costs, sizes = sweep.Costs( dt ), []
+        start = time.time()
+        for rec in fb.iter_closed_loop( setpoint, c, p, tm, monitor=False,
+                                        dt=dt ):
+            costs.add( rec )
+            sizes.append( rec.u )
+        rate = tm/( time.time() - start )
+
+        print cls.__name__, int(rate), costs.iae, sum( sizes[-2000:] )/2000.0
+
+
+class SortingCache( fb.Component ):
+    # Original implementation: sorts all keys on every eviction.
+    # Only kept as reference for benchmark()
+
+    def __init__( self, size, demand ):
+        self.t = 0        # internal time counter, needed for last access time
+        
+        self.size = size  # size limit of cache
+        self.cache = {}   # actual cache: cache[key] = last_accessed_time
+
+        self.demand = demand # demand function
+
+    def work( self, u ):
+        self.t += 1
+
+        self.size = max( 0, int(u) ) # non-negative integer
+
+        i = self.demand( self.t )    # this is the "requested item"
+
+        if i in self.cache:
+            self.cache[i] = self.t   # update last access time
+            return 1
+
+        if len(self.cache) >= self.size: # must make room
+            m = 1 + len(self.cache) - self.size # number of elements to delete
+
+            tmp = {}
+            for k in self.cache.keys():    # key by last_access_time
+                tmp[ self.cache[k] ] = k
+                
+            for t in sorted( tmp.keys() ): # delete the oldest elements
+                del self.cache[ tmp[t] ]
+                m -= 1
+                if m == 0:
+                    break
+
+        self.cache[i] = self.t       # insert into cache
+        return 0
 
 
 # ============================================================    
         
 if __name__ == '__main__':
 
-    fb.DT = 1
+    fb.DT = DT
 
     # statictest(35)  # 5, 15, 35  
+    # statictest_parallel(35)
 
     # stepresponse()
+    # identify()
+    # autotune()
 
     # closedloop()
+    # convert_trace( "access.log", "access.trace" )
+    # closedloop_trace( "access.trace" )
     
     closedloop_jumps()
+
+    # closedloop_bands()
+
+    # closedloop_profiled()
+
+    # policies()
+
+    # benchmark()
@@ -1,14 +1,18 @@
 
+import sys
 import math
 import random
+import numpy as np
 import feedback as fb
+import batch as bt
 
 class AdPublisher( fb.Component ):
 
-    def __init__( self, scale, min_price, relative_width=0.1 ):
+    def __init__( self, scale, min_price, relative_width=0.1, rng=random ):
         self.scale = scale
         self.min = min_price
         self.width = relative_width
+        self.rng = rng          # random module, or a fb.RandomStream
 
     def work( self, u ):
         if u <= self.min:       # Price below min: no impressions
@@ -19,15 +23,16 @@ class AdPublisher( fb.Component ):
         # a mean that depends logarithmically on the price u.
         
         mean = self.scale*math.log( u/self.min )        
-        demand = int( random.gauss( mean, self.width*mean ) )
+        demand = int( self.rng.gauss( mean, self.width*mean ) )
 
         return max( 0, demand ) # Impression demand is greater than zero
 
 
 class AdPublisherWithWeekend( AdPublisher ):
     
-    def __init__( self, weekday, weekend, min_price, relative_width=0.1 ):
-        AdPublisher.__init__( self, None, min_price, relative_width )
+    def __init__( self, weekday, weekend, min_price, relative_width=0.1,
+                  rng=random ):
+        AdPublisher.__init__( self, None, min_price, relative_width, rng )
 
         self.weekday = weekday
         self.weekend = weekend        
@@ -43,14 +48,53 @@ class AdPublisherWithWeekend( AdPublisher ):
             self.scale = self.weekday
 
         return AdPublisher.work( self, u )
+
+
+class BatchAdPublisher( bt.Component ):
+    # Vectorized AdPublisher: u is an array of prices, one per replica
+
+    def __init__( self, scale, min_price, relative_width=0.1, seed=None ):
+        self.scale = scale
+        self.min = min_price
+        self.width = relative_width
+        self.rng = np.random.RandomState( seed )
+
+    def work( self, u ):
+        u = np.asarray( u, dtype=float )
+        served = u > self.min   # Price below min: no impressions
+
+        mean = self.scale*np.log( np.where( served, u, self.min )/self.min )
+        demand = np.trunc( self.rng.normal( mean, self.width*mean ) )
+
+        return np.where( served, np.maximum( 0, demand ), 0 )
     
 # ------------------------------------------------------------
 
-def statictest():
-    fb.static_test( AdPublisher, (100,2), 20, 100, 10, 5000 )
+DT = 1 # Sampling interval of the scenarios
+
+# Scenarios take the sampling interval dt, the source of random numbers
+# rng (random module, or a fb.RandomStream), and the sink for their output
+# (stdout if None), so that they can also run side by side
+
+def statictest( dt=DT, rng=random, sink=None ):
+    fb.static_test( AdPublisher, (100, 2, 0.1, rng), 20, 100, 10, 5000,
+                    dt=dt, sink=sink )
+
+def statictest_batch( seed=None, dt=DT ):
+    u, mean, std = bt.static_test( BatchAdPublisher, (100,2), 20, 100, 10, 5000,
+                                   seed=seed, dt=dt )
+    bt.print_static( u, mean, std )
 
+def statictest_batch_seeded( seed=3 ):
+    # Two runs with the same seed must agree
+    runs = [ bt.static_test( BatchAdPublisher, (100,2), 20, 100, 10, 500,
+                             seed=seed, dt=DT ) for _ in range( 2 ) ]
+    for a, b in zip( *runs ):
+        assert np.array_equal( a, b ), "Seeded static tests differ"
+    print "# identical"
 
-def closedloop( kp, ki, f=fb.Identity() ):
+
+def closedloop( kp, ki, f=fb.Identity(), dt=DT, rng=random, sink=None ):
     def setpoint( t ):
         if t > 1000:
             return 125
@@ -58,52 +102,121 @@ def closedloop( kp, ki, f=fb.Identity() ):
 
     k = 1.0/20.0
 
-    p = AdPublisher( 100, 2 )
+    p = AdPublisher( 100, 2, rng=rng )
     c = fb.PidController( k*kp, k*ki )
 
-    fb.closed_loop( setpoint, c, p, returnfilter=f )
+    fb.closed_loop( setpoint, c, p, returnfilter=f, dt=dt, sink=sink )
 
 
-accumul_goal = 0
-def closedloop_accumul( kp, ki ):
+def closedloop_bands( kp, ki, n=500, f=None, seed=None, dt=DT ):
+    # Same as closedloop(), but for n noisy replicas at once
     def setpoint( t ):
-        global accumul_goal
-        
         if t > 1000:
-            accumul_goal += 125
-        else:
-            accumul_goal += 100
-        return accumul_goal
+            return 125
+        return 100
+
+    k = 1.0/20.0
+
+    p = BatchAdPublisher( 100, 2, seed=seed )
+    c = bt.PidController( k*kp, k*ki, n=n )
+    if f is None: f = bt.Identity()
+
+    traj = bt.closed_loop( setpoint, c, p, n, returnfilter=f,
+                           channels=('u','y'), dt=dt )
+    traj.print_bands( 'y' )
+
+
+def campaigns( n=10000, seed=None, dt=DT ):
+    # One controller per ad campaign, each with its own impression goal;
+    # all controllers are held in a single PidBank. Goals and impressions
+    # are indexed by controller handle.
+    k = 1.0/20.0
+
+    goals = np.random.RandomState( seed ).uniform( 50, 150, n )
+    y = np.zeros( n )
+
+    p = BatchAdPublisher( 100, 2, seed=seed )
+    c = bt.PidBank( n, dtype=np.float32 )
+    c.add( k*0.5*np.ones( n ), k*0.25 )
+    c.bind( dt )
+
+    for t in range( 2000 ):
+        if t == 1000:             # some campaigns end
+            for h in range( 0, n, 10 ):
+                c.remove( h )
+
+        s = c.slots()
+        u = c.work( goals[s] - y[s] )
+        y[s] = p.work( u )
+
+        print t, t*dt, np.mean( np.abs( goals[s] - y[s] )/goals[s] ), c.n
+
+
+def gainsweep( dt=DT ):
+    # Rank (kp, ki) for closedloop() by IAE, instead of reading traces
+    import sweep
+
+    def setpoint( t ):
+        if t > 1000:
+            return 125
+        return 100
+
+    def scenario( kp, ki, kd ):
+        k = 1.0/20.0
+
+        p = AdPublisher( 100, 2 )
+        c = fb.PidController( k*kp, k*ki, k*kd )
+
+        return fb.iter_closed_loop( setpoint, c, p, 2000, monitor=False,
+                                    dt=dt )
+
+    gains = sweep.grid( [ 0.0, 0.25, 0.5, 1.0, 2.0 ],
+                        [ 0.125, 0.25, 0.5, 1.0, 1.75 ] )
+    sweep.print_table( sweep.sweep( scenario, gains, seed=1, dt=dt ) )
+
+
+def closedloop_accumul( kp, ki, dt=DT, rng=random, sink=None ):
+    def setpoint( t ):
+        # Cumulative goal: 100 per step up to t=1000, then 125 per step
+        if t > 1000:
+            return 100*1001 + 125*( t - 1000 )
+        return 100*( t + 1 )
     
     k = 1.0/20.0
 
-    p = AdPublisher( 100, 2 )
+    p = AdPublisher( 100, 2, rng=rng )
     c = fb.PidController( k*kp, k*ki )
 
-    fb.closed_loop( setpoint, c, p, returnfilter=fb.Integrator() )
+    fb.closed_loop( setpoint, c, p, returnfilter=fb.Integrator(), dt=dt,
+                    sink=sink )
 
 
-def specialsteptest():
-    p = AdPublisher( 100, 2 )
+def specialsteptest( dt=DT, rng=random, sink=None ):
+    p = AdPublisher( 100, 2, rng=rng )
     f = fb.RecursiveFilter(0.05)
-    
-    for t in range( 500 ):
-        r = 5.50
-        u = r
-        y = p.work( u )
-        z = f.work( y )
+    fb.bind( dt, [ p, f ] )
 
-        print t, t*fb.DT, r, 0, u, u, y, z, p.monitoring()
-        
+    def records():
+        for t in range( 500 ):
+            r = 5.50
+            u = r
+            y = p.work( u )
+            z = f.work( y )
+
+            yield fb.Step( t, t*dt, r, 0, u, u, y, z, p.monitoring() )
+
+    fb.drain( records(), sink or fb.FileSink( sys.stdout ) )
     quit()
     
 # ------------------------------------------------------------
 
 if __name__ == '__main__':
 
-    fb.DT = 1
+    fb.DT = DT
 
 #   statictest()
+#   statictest_batch()
+#   statictest_batch_seeded()
 
 #    closedloop( 0.5, 0.25 ) # default
 #    closedloop( 0.0, 0.25 ) # w/o prop ctrl
@@ -112,3 +225,9 @@ if __name__ == '__main__':
 #    closedloop( 1.0, 0.125, fb.RecursiveFilter(0.125) ) # 
         
 #    closedloop_accumul( 0.5, 0.125 )
+
+#    closedloop_bands( 0.5, 0.25 )
+
+#    gainsweep()
+
+#    campaigns()
@@ -1,32 +1,61 @@
 
 import math
 import random
+from collections import deque
 import feedback as fb
 
 class AbstractServerPool( fb.Component ):
-    def __init__( self, n, server, load ):
+    # Modes: 'scalar' calls server() once per server; 'batch' draws the
+    # work of many servers at once with server.draw(n); 'aggregate' draws
+    # the total work of all servers directly with server.total(n).
+    
+    def __init__( self, n, server, load, mode='scalar', chunk=1024 ):
         self.n = n           # number of server instances
         self.queue = 0       # number of items in queue
 
         self.server = server # server work function
         self.load = load     # queue-loading work function
 
+        self.mode = mode
+        self.chunk = chunk   # servers per draw in batch mode
+
 
     def work( self, u ):
         self.n = max(0, int(round(u))) # server count: non-negative integer
 
-        completed = 0
-        for _ in range(self.n):
-            completed += self.server() # each server does some amount of work
+        if self.mode == 'batch':
+            completed = self._batch()
+        elif self.mode == 'aggregate':
+            completed = self._aggregate()
+        else:
+            completed = 0
+            for _ in range(self.n):
+                completed += self.server() # each server does some work
 
-            if completed >= self.queue:
-                completed = self.queue # "trim" completed to queue length
-                break                  # stop if queue is empty 
+                if completed >= self.queue:
+                    completed = self.queue # "trim" completed to queue length
+                    break                  # stop if queue is empty 
 
         self.queue -= completed        # reduce queue by work completed
 
         return completed
 
+    def _batch( self ):
+        completed, left = 0, self.n
+        while left > 0 and completed < self.queue: # stop if queue is empty
+            m = min( left, self.chunk )
+            completed += float( self.server.draw( m ).sum() )
+            left -= m
+
+        if self.n > 0:
+            completed = min( completed, self.queue ) # "trim" to queue length
+        return completed
+
+    def _aggregate( self ):
+        if self.n == 0:
+            return 0
+        return min( self.server.total( self.n ), self.queue )
+
 
     def monitoring( self ):
         return "%d %d" % ( self.n, self.queue )
@@ -55,78 +84,135 @@ class QueueingServerPool( AbstractServerPool ):
 
         
 class ServerPoolWithLatency( ServerPool ):
-    def __init__( self, n, server, load, latency ):
-        ServerPool.__init__( self, n, server, load )
+    def __init__( self, n, server, load, latency, mode='scalar' ):
+        ServerPool.__init__( self, n, server, load, mode )
 
         self.latency = latency  # time steps before server becomes active
-        self.pending = []       # list of pending servers
+
+        self.pending = deque()  # pending servers: [activation_tick, count]
+        self.npending = 0       # total number of pending servers
+        self.activated = 0      # servers that became active in last step
+        self.tick = 0           # pending servers only wait during steps
+                                # that request an increase in servers
 
 
     def work( self, u ):
         u = max(0, int(round(u)))  # server count: non-negative integer
 
+        self.activated = 0
+
         if u <= self.n:            # no increase in servers: no latency
             return ServerPool.work( self, u )
 
-        # for servers already pending: decrement waiting time
-        for i in range( len(self.pending) ):
-            self.pending[i] -= 1
+        # for servers already pending: advance waiting time
+        self.tick += 1
 
-        newly_active = self.pending.count( 0 ) # how many are done waiting?
-        del self.pending[0:newly_active]       # remove from pending...
-        self.n += newly_active                 # ... and add to active
+        while self.pending and self.pending[0][0] <= self.tick:
+            self.activated += self.pending.popleft()[1] # done waiting...
+        self.npending -= self.activated
+        self.n += self.activated                        # ... add to active
 
-        # now add to list of pending servers if requested by input
-        self.pending.extend( [self.latency]*int(u-self.n) )
+        # now add to pending servers if requested by input
+        new = int(u-self.n)
+        if new > 0:
+            when = self.tick + self.latency
+            if self.pending and self.pending[-1][0] == when:
+                self.pending[-1][1] += new
+            else:
+                self.pending.append( [when, new] )
+            self.npending += new
 
         return ServerPool.work( self, self.n )
 
+
+    def monitoring( self ):
+        return "%d %d %d %d" % ( self.n, self.queue,
+                                 self.npending, self.activated )
+
     
 # --------------------------------------------------
 
 # Load and work functions (unless defined in local scope)
 
-def load_queue():
-    # This is only used by closedloop2() and closedloop3()
-    
-    global global_time
-    global_time += 1
+class QueueLoad:
+    # Gaussian load, with a mean that changes after some number of calls
+    # (the defaults are the load of closedloop2() and closedloop3()):
+    # changes is a list of ( calls, mean ), checked in order. The number
+    # of calls is the clock of the load (one call per step of the pool).
+
+    def __init__( self, changes=( (2500, 1200), (2200, 800) ), mean=1000,
+                  width=5, rng=random ):
+        self.changes = changes
+        self.mean, self.width = mean, width
+        self.rng = rng
+        self.t = 0
 
-    if global_time > 2500:
-        return random.gauss( 1200, 5 )
+    def __call__( self ):
+        self.t += 1
 
-    if global_time > 2200:
-        return random.gauss( 800, 5 )
+        for calls, mean in self.changes:
+            if self.t > calls:
+                return self.rng.gauss( mean, self.width )
 
-    return random.gauss( 1000, 5 )
+        return self.rng.gauss( self.mean, self.width )
 
-def consume_queue():
+def consume_queue( rng=random ):
     a, b = 20, 2
-    return 100*random.betavariate( a, b ) # mean: a/(a+b); var: ~b/a^2
+    return 100*rng.betavariate( a, b ) # mean: a/(a+b); var: ~b/a^2
+
+
+class BetaServer:
+    # Same work model as consume_queue(), but can also draw for n servers
+    # at once: as an array, or as the total of all n (for large n)
+
+    def __init__( self, a=20, b=2, scale=100, rng=random ):
+        self.a, self.b, self.scale = a, b, scale
+        self.rng = rng    # random module, or a fb.RandomStream
+
+    def __call__( self ):
+        return self.scale*self.rng.betavariate( self.a, self.b )
+
+    def draw( self, n ):
+        # In one call from a RandomStream; one at a time from the random
+        # module (slow for large n)
+        import numpy as np
+
+        if isinstance( self.rng, fb.RandomStream ):
+            x = self.rng.betavariates( self.a, self.b, n )
+        else:
+            x = [ self.rng.betavariate( self.a, self.b ) for _ in range( n ) ]
+        return self.scale*np.asarray( x )
+
+    def total( self, n ):
+        # Sum of n draws, normal approximation (central limit theorem)
+        a, b, s = float(self.a), float(self.b), self.scale
+        mean = s*a/(a + b)
+        var = s*s*a*b/( (a + b)**2*(a + b + 1) )
+
+        return max( 0, self.rng.gauss( n*mean, math.sqrt( n*var ) ) )
 
 # ============================================================
 
+DT = 1 # Sampling interval of the scenarios
+
+# Scenarios take the sampling interval dt, the source of random numbers
+# rng (random module, or a fb.RandomStream), and the sink for their output
+# (stdout if None), so that they can also run side by side
+
 # Server Pool
 
-def statictest( traffic ):
+def statictest( traffic, dt=DT, rng=random, sink=None ):
     def loadqueue():
-        return random.gauss( traffic, traffic/200 )
+        return rng.gauss( traffic, traffic/200 )
     
-    fb.static_test( ServerPool, ( 0, consume_queue, loadqueue ),
-                    20, 20, 5, 1000 ) # max u, steps, trials, timesteps
+    fb.static_test( ServerPool, ( 0, BetaServer( rng=rng ), loadqueue ),
+                    20, 20, 5, 1000, # max u, steps, trials, timesteps
+                    dt=dt, sink=sink )
 
-def closedloop1():
+def closedloop1( dt=DT, rng=random, sink=None ):
     # Closed loop, setpoint 0.6-0.8, PID Controller
-    
-    def loadqueue():
-        global global_time
-        global_time += 1
-
-        if global_time > 2100:
-            return random.gauss( 1200, 5 )
-
-        return random.gauss( 1000, 5 )
 
+    loadqueue = QueueLoad( [ (2100, 1200) ], rng=rng )
 
     def setpoint( t ):
         if t > 2000:
@@ -135,12 +221,12 @@ def closedloop1():
             return 0.8
 
 
-    p = ServerPool( 8, consume_queue, loadqueue )
+    p = ServerPool( 8, BetaServer( rng=rng ), loadqueue )
     c = fb.PidController( 1, 5 )
-    fb.closed_loop( setpoint, c, p, 10000 )
+    fb.closed_loop( setpoint, c, p, 10000, dt=dt, sink=sink )
 
     
-def closedloop2():
+def closedloop2( dt=DT, rng=random, sink=None ):
     # Closed loop, setpoint 0.999x, Asymm (!) Controller
     
     def setpoint( t ):
@@ -153,18 +239,18 @@ def closedloop2():
             if e > 0:
                 e /= 20.0
         
-            self.i += fb.DT*e
-            self.d = ( self.prev - e )/fb.DT
+            self.i += self.dt*e
+            self.d = ( self.prev - e )/self.dt
             self.prev = e
 
             return self.kp*e + self.ki*self.i + self.kd*self.d
 
-    p = ServerPool( 0, consume_queue, load_queue )
+    p = ServerPool( 0, BetaServer( rng=rng ), QueueLoad( rng=rng ) )
     c = AsymmController( 10, 200 )
-    fb.closed_loop( setpoint, c, p )
+    fb.closed_loop( setpoint, c, p, dt=dt, sink=sink )
 
 
-def closedloop3():
+def closedloop3( dt=DT, rng=random, sink=None ):
     # Closed loop, setpoint 1.0, incremental controller (non-PID)
 
     def setpoint( t ):
@@ -189,20 +275,40 @@ def closedloop3():
 
             return 0
 
-    p = ServerPool( 0, consume_queue, load_queue )
+    p = ServerPool( 0, BetaServer( rng=rng ), QueueLoad( rng=rng ) )
     c = SpecialController( 100, 10 )
-    fb.closed_loop( setpoint, c, p, actuator=fb.Integrator() )
+    fb.closed_loop( setpoint, c, p, actuator=fb.Integrator(), dt=dt,
+                    sink=sink )
+
+def closedloop_largepool( mode='aggregate', dt=DT, rng=random, sink=None ):
+    # Like closedloop1(), but for a pool of several thousand servers. The
+    # servers draw from a RandomStream (batch draws), rng if it is one.
+
+    def loadqueue():
+        return rng.gauss( 400000, 2000 )
+
+    def setpoint( t ):
+        return 0.8
+
+    if not isinstance( rng, fb.RandomStream ):
+        server = BetaServer( rng=fb.RandomStream() )
+    else:
+        server = BetaServer( rng=rng )
+
+    p = ServerPool( 0, server, loadqueue, mode )
+    c = fb.PidController( 500, 2500 )
+    fb.closed_loop( setpoint, c, p, 1000, dt=dt, sink=sink )
 
 # ============================================================
 
 # Queue Control
 
 class InnerLoop( fb.Component ):
-    def __init__( self, kp, ki, loader ):
+    def __init__( self, kp, ki, loader, rng=random ):
         k = 1/100.
         
         self.c = fb.PidController( kp*k, ki*k )
-        self.p = QueueingServerPool( 0, consume_queue, loader )
+        self.p = QueueingServerPool( 0, BetaServer( rng=rng ), loader )
 
         self.y = 0
 
@@ -217,7 +323,7 @@ class InnerLoop( fb.Component ):
         return "%s %d" % ( self.p.monitoring(), self.y ) # servers, queue, diff
 
 
-def innerloop_steptest():
+def innerloop_steptest( dt=DT, rng=random, sink=None ):
     def loadqueue():
         return 1000
 
@@ -227,11 +333,11 @@ def innerloop_steptest():
         else:
             return -25
     
-    p = InnerLoop( 0.5, 0.25, loadqueue )
-    fb.step_response( setpoint, p, tm=2000 )
+    p = InnerLoop( 0.5, 0.25, loadqueue, rng )
+    fb.step_response( setpoint, p, tm=2000, dt=dt, sink=sink )
 
 
-def nestedloops():
+def nestedloops( dt=DT, rng=random, sink=None ):
     def setpoint( t ):
         return 200
         
@@ -242,13 +348,29 @@ def nestedloops():
         else:
             return 25
 
-    p = InnerLoop(0.5, 0.25, load_queue) # InnerLoop is "plant" for outer loop
+    p = InnerLoop(0.5, 0.25, QueueLoad( rng=rng ), rng) # "plant" for outer loop
 
 #    c = fb.PidController( 0.06, 0.001 )
     c = fb.AdvController( 0.35, 0.0025, 4.5, smooth=0.15 )
     
 #    fb.closed_loop( setpoint, c, p )
-    fb.closed_loop( setpoint, c, p, actuator=fb.RecursiveFilter(0.5) )
+    fb.closed_loop( setpoint, c, p, actuator=fb.RecursiveFilter(0.5), dt=dt,
+                    sink=sink )
+
+
+def nestedloops_multirate( period=2, dt=DT, rng=random, sink=None ):
+    # nestedloops(), with the outer controller and its filter running only
+    # every period steps; the inner loop still runs every step. (The gains
+    # are those of nestedloops(): control gets worse as period grows.)
+    def setpoint( t ):
+        return 200
+
+    p = InnerLoop(0.5, 0.25, QueueLoad( rng=rng ), rng)
+
+    c = fb.Sampled( fb.AdvController( 0.35, 0.0025, 4.5, smooth=0.15 ), period )
+    a = fb.Sampled( fb.RecursiveFilter(0.5), period )
+
+    fb.closed_loop( setpoint, c, p, actuator=a, dt=dt, sink=sink )
 
 
 
@@ -256,15 +378,15 @@ def nestedloops():
 
 if __name__ == '__main__':
 
-    fb.DT = 1
-
-    global_time = 0 # To communicate with queue_load functions
+    fb.DT = DT
 
 #    statictest( 1000 )
 #    closedloop1()
 #    closedloop2()
 #    closedloop3()
+#    closedloop_largepool()
 
 #    innerloop_steptest()
 
     nestedloops()
+#    nestedloops_multirate()
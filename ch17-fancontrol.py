@@ -1,9 +1,12 @@
 
+import time
 import random
+import numpy as np
 import feedback as fb
+import batch as bt
 
 class CpuWithCooler( fb.Component ):
-    def __init__( self, jumps=False, drift=False ):
+    def __init__( self, jumps=False, drift=False, rng=random ):
         self.ambient = 20             # ambient temperature (in Celsius)
         self.temp    = self.ambient   # initial state: temperature
 
@@ -21,6 +24,8 @@ class CpuWithCooler( fb.Component ):
         self.jumps = jumps            # Are there jumps in processor load?
         self.drift = drift            # Is there drift in ambient temp?
 
+        self.rng = rng                # random module, or a fb.RandomStream
+
 
     def work( self, u ):
         u = max( 0, min( u, 10 ) )     # Actuator saturation
@@ -33,73 +38,267 @@ class CpuWithCooler( fb.Component ):
         
         flow = self.wattage + self.current_load # Heat inflow to processor
 
-        self.temp += fb.DT*( -loss*diff + self.specific_heat*flow )
+        self.temp += self.dt*( -loss*diff + self.specific_heat*flow )
         return self.temp
 
 
     def _load_changes( self ):
         if self.jumps == False: return
 
-        if random.randint( 0, 2*self.load_change_seconds/fb.DT ) == 0:
-            self.current_load = self.load_wattage_factor*random.randint( 0, 5 )
+        if self.rng.randint( 0, 2*self.load_change_seconds/self.dt ) == 0:
+            self.current_load = self.load_wattage_factor*self.rng.randint( 0, 5 )
 
     def _ambient_drift( self ):
         if self.drift == False: return
         
-        self.ambient += fb.DT*random.gauss( 0, self.ambient_drift )
+        self.ambient += self.dt*self.rng.gauss( 0, self.ambient_drift )
         self.ambient = max( 0, min( self.ambient, 40 ) ) # limit drift
 
 
     def monitoring( self ):
         return "%f" % ( self.current_load, )
 
+
+class CpuFleet( bt.Component ):
+    # Vectorized CpuWithCooler for the n CPUs of a rack: temperature, load
+    # and fan setting are arrays; the ambient temperature (and its drift)
+    # is shared by the rack. Random numbers are drawn in blocks of steps:
+    # the drift, and the number of CPUs whose load jumps in each step.
+    #
+    # Each CPU changes load as often as a CpuWithCooler; the fraction
+    # correlation of these changes are rack-wide events, in which that
+    # fraction of the CPUs jump to the same load together.
+
+    def __init__( self, n, jumps=False, drift=False, correlation=0.0,
+                  seed=None, block=1024 ):
+        self.n = n
+        self.ambient = 20.0
+        self.temp = np.zeros( n ) + self.ambient
+
+        self.wattage = 75
+        self.specific_heat = 1.0/50.0
+        self.loss_factor = 1.0/120.0
+
+        self.load_wattage_factor = 10
+        self.load_change_seconds = 50
+        self.current_load = np.zeros( n )
+        self._heat()
+
+        self.ambient_drift = 1.0/3600
+
+        self.jumps = jumps
+        self.drift = drift
+        self.correlation = correlation
+
+        self.rng = np.random.RandomState( seed )
+        self.block = block
+        self.k = block                # next step within the block of draws
+
+    def _heat( self ):                # heat inflow, per CPU
+        self.heat = self.specific_heat*( self.wattage + self.current_load )
+
+    def _draw( self ):
+        p = 1.0/( 2*self.load_change_seconds/self.dt + 1 ) # as randint()
+        c = self.correlation
+
+        # As lists: indexing them is faster than indexing arrays
+        self.movers = self.rng.binomial( self.n, p*( 1 - c ),
+                                         self.block ).tolist()
+        self.rack = ( self.rng.random_sample( self.block ) <
+                      p*( c > 0 ) ).tolist()
+        self.drifts = self.rng.normal( 0, self.ambient_drift,
+                                       self.block ).tolist()
+        self.k = 0
+
+    def work( self, u ):
+        u = np.clip( u, 0, 10 )       # Actuator saturation
+        dt = self.dt
+
+        if self.k == self.block: self._draw()
+        k = self.k
+        self.k += 1
+
+        if self.drift:
+            self.ambient += dt*self.drifts[k]
+            self.ambient = max( 0, min( self.ambient, 40 ) )
+
+        if self.jumps and ( self.movers[k] or self.rack[k] ):
+            self._load_changes( k )
+
+        loss = self.loss_factor*( 1 + u )
+        self.temp = self.temp + dt*( self.heat -
+                                     loss*( self.temp - self.ambient ) )
+        return self.temp
+
+    def _load_changes( self, k ):
+        m = self.movers[k]
+        if m:
+            i = self.rng.randint( 0, self.n, m )
+            self.current_load[i] = self.load_wattage_factor*self.rng.randint( 0, 6, m )
+
+        if self.rack[k]:
+            i = self.rng.random_sample( self.n ) < self.correlation
+            self.current_load[i] = self.load_wattage_factor*self.rng.randint( 0, 6 )
+
+        self._heat()
+
 # ============================================================
 
-def no_fan():
+DT = 0.01 # Sampling interval of the scenarios
+
+# Scenarios take the sampling interval dt, the source of random numbers
+# rng (random module, or a fb.RandomStream), and the sink for their output
+# (stdout if None), so that they can also run side by side
+
+def no_fan( dt=DT, rng=random, sink=None ):
     def setpoint(t): return 0
     
-    p = CpuWithCooler()
-    fb.step_response( setpoint, p, 60000 )    
+    p = CpuWithCooler( rng=rng )
+    fb.step_response( setpoint, p, 60000, dt=dt, sink=sink )    
 
 
-def min_fan():
+def min_fan( dt=DT, rng=random, sink=None ):
     def setpoint(t): return 1
     
-    p = CpuWithCooler()
-    fb.step_response( setpoint, p, 60000 )    
+    p = CpuWithCooler( rng=rng )
+    fb.step_response( setpoint, p, 60000, dt=dt, sink=sink )    
 
 
-def measurement( s ):
+def measurement( s, dt=DT, rng=random, sink=None ):
     def setpoint(t):
-        if t<5*60/fb.DT: return 1
+        if t<5*60/dt: return 1
         else: return s
 
-    p = CpuWithCooler()
-    fb.step_response( setpoint, p, 60000 )    
+    p = CpuWithCooler( rng=rng )
+    fb.step_response( setpoint, p, 60000, dt=dt, sink=sink )    
 
 
-def production():
+def production( dt=DT, rng=random, sink=None ):
     def setpoint(t):
-        if t*fb.DT < 6*60: return 50
+        if t*dt < 6*60: return 50
         else: return 45
 #        if t < 40000: return 50
 #        else: return 45
 
-    p = CpuWithCooler( True, True ); p.temp = 50 # Initial temp
+    p = CpuWithCooler( True, True, rng ); p.temp = 50 # Initial temp
     c = fb.AdvController( 2, 0.5, 0, clamp=(0,10) )
 
     fb.closed_loop( setpoint, c, p, 100000, inverted=True,
-                    actuator=fb.Limiter( 0, 10 ) )
+                    actuator=fb.Limiter( 0, 10 ), dt=dt, sink=sink )
+
+
+def production_multirate( period=1.0, dt=DT, rng=random, sink=None ):
+    # production(), with the controller sampling only every period seconds;
+    # the plant still runs every dt
+    def setpoint(t):
+        if t*dt < 6*60: return 50
+        else: return 45
+
+    p = CpuWithCooler( True, True, rng ); p.temp = 50 # Initial temp
+    c = fb.Sampled( fb.AdvController( 2, 0.5, 0, clamp=(0,10) ), period )
+
+    fb.closed_loop( setpoint, c, p, 100000, inverted=True,
+                    actuator=fb.Limiter( 0, 10 ), dt=dt, sink=sink )
+
+
+def production_branches( dt=DT, rng=random ):
+    # Warm up production() once, until just before the setpoint change,
+    # then branch: same warmed-up system, different controller gains
+    import sweep
+
+    def setpoint(t):
+        if t*dt < 6*60: return 50
+        else: return 45
+
+    p = CpuWithCooler( True, True, rng ); p.temp = 50 # Initial temp
+    c = fb.AdvController( 2, 0.5, 0, clamp=(0,10) )
+    a = fb.Limiter( 0, 10 )
+
+    warmup = int( 6*60/dt ) - 100
+    for rec in fb.iter_closed_loop( setpoint, c, p, warmup, inverted=True,
+                                    actuator=a, monitor=False, dt=dt ):
+        pass
+    checkpoint = fb.Checkpoint( [ p, c ], warmup, rec.z )
+
+    def continuation( gains ):
+        c.kp, c.ki, c.kd = gains # bumpless: keep the controller state
+        records = fb.iter_closed_loop( setpoint, c, p, 100000 - warmup,
+                                       inverted=True, actuator=a,
+                                       monitor=False, start=checkpoint.t,
+                                       z=checkpoint.z, dt=dt )
+        return sweep.costs( records, dt )
+
+    gains = sweep.grid( [ 1, 2, 4 ], [ 0.25, 0.5, 1.0 ] )
+
+    # Round trip: the same branch, twice from the checkpoint, is the same
+    again = fb.branch( checkpoint, [ p, c ], gains[:1]*2, continuation )
+    assert again[0] == again[1], "Checkpoint did not restore the plant"
+
+    results = fb.branch( checkpoint, [ p, c ], gains, continuation,
+                         processes=None )
+    sweep.print_table( sorted( zip( gains, results ),
+                               key=lambda item: item[1]['iae'] ) )
+
+
+def fleet( n=1000, seconds=3600, correlation=0.5, dt=DT ):
+    # production() for a rack of n CPUs, with batched controllers. Prints
+    # temperatures (mean, max) and fan settings (mean, max) once a minute.
+    def setpoint(t):
+        if t*dt < 6*60: return 50
+        else: return 45
+
+    p = CpuFleet( n, True, True, correlation ); p.temp += 30 # 50 deg
+    c = bt.AdvController( 2, 0.5, 0, clamp=(0,10), n=n )
+    a = bt.Limiter( 0, 10 )
+    fb.bind( dt, [ p, c, a ] )
+
+    minute = int( round( 60/dt ) )
+    start = time.time()
+
+    print "# t time temp_mean temp_max fan_mean fan_max ambient"
+    z = p.temp
+    for t in range( int( round( seconds/dt ) ) ):
+        e = z - setpoint(t)           # inverted
+        v = a.work( c.work( e ) )
+        z = p.work( v )
+
+        if t % minute == 0:
+            print t, t*dt, z.mean(), z.max(), v.mean(), v.max(), p.ambient
+
+    steps = int( round( seconds/dt ) )
+    print "# %d steps of %d CPUs in %.1f s" % ( steps, n, time.time() - start )
+
+
+def realtime( n=10, seconds=10, dt=DT, rng=random ):
+    # n fan controllers at wall-clock rate, against simulated CPUs
+    import realtime as rt
+
+    def setpoint(t): return 50
+
+    s = rt.Scheduler()
+    for k in range( n ):
+        p = CpuWithCooler( True, True, rng ); p.temp = 50
+        a = rt.SimulatedPlant( p, dt=dt, y=p.temp )
+        c = fb.AdvController( 2, 0.5, 0, clamp=(0,10) )
+
+        s.add( rt.Loop( "cpu%d" % k, setpoint, c, a, a, dt, inverted=True ) )
+
+    s.run( seconds )
+    s.report()
 
     
 if __name__ == '__main__':
 
-    fb.DT = 0.01
+    fb.DT = DT
 
     # no_fan()
     # min_fan()
 
     # measurement( 5 ) # fan speed: 2, 3, 4, 5
     production()
+    # production_multirate()
+    # production_branches()
+    # fleet()
+    # realtime()
     
 
@@ -1,21 +1,25 @@
 
 import math
+import time
 import random
+import numpy as np
 import feedback as fb
+import batch as bt
 
 class GameEngine( fb.Component ):
-    def __init__( self ):
+    def __init__( self, rng=random ):
         self.n = 0    # Number of game objects
         self.t = 0    # Steps since last change
+        self.rng = rng  # random module, or a fb.RandomStream
 
         self.resolutions = [ 100, 200, 400, 800, 1600 ] # memory per game obj
 
     def work( self, u ):
         self.t += 1
 
-        if self.t > random.expovariate( 0.1 ):   # 1 chg every 10 steps on avg
+        if self.t > self.rng.expovariate( 0.1 ):   # 1 chg every 10 steps on avg
             self.t = 0
-            self.n += random.choice( [-1,1] ) 
+            self.n += self.rng.choice( [-1,1] ) 
             self.n = max( 1, min( self.n, 50 ) ) # 1 <= n <= 50
         
         crr = self.resolutions[u] # current resolution
@@ -53,16 +57,164 @@ class Logarithm( fb.Component ):
         return math.log(u)
 
 
-if __name__ == '__main__':
+# ============================================================
+# Fleet: many engines sharing one memory budget
+
+RESOLUTIONS = np.array( [ 100, 200, 400, 800, 1600 ] )
+
+class GameFleet( bt.Component ):
+    # n GameEngines: object counts and steps since the last change are
+    # arrays, and the changes of all engines are drawn in one call per
+    # step. work() takes the resolution level of each engine, and returns
+    # the memory use of each engine.
 
-    fb.DT = 1
+    def __init__( self, n, seed=None ):
+        self.objects = np.zeros( n, dtype=int ) # game objects per engine
+        self.t = np.zeros( n )                  # steps since last change
+        self.rng = np.random.RandomState( seed )
+
+    def work( self, u ):
+        self.t += 1
 
+        # 1 chg every 10 steps on avg, as in GameEngine
+        change = self.t > self.rng.standard_exponential( len(self.t) )/0.1
+        m = np.count_nonzero( change )
+        if m:
+            self.t[change] = 0
+            self.objects[change] += 2*self.rng.randint( 0, 2, m ) - 1
+            np.clip( self.objects, 1, 50, out=self.objects )
+
+        return RESOLUTIONS[u]*self.objects
+
+# --- Allocation policies: work() takes the memory use of each engine in
+# the last step, and returns the resolution level for each engine
+
+class Allocator( bt.Component ):
+    def __init__( self, budget, n ):
+        self.budget = budget
+        self.levels = np.zeros( n, dtype=int ) # levels assigned last step
+
+    def objects( self, y ):      # object counts, from memory use and levels
+        return y//RESOLUTIONS[ self.levels ]
+
+    def fill( self, objects, level, budget ):
+        # All engines at level, and as many as fit at level+1: those with
+        # the fewest objects (smallest cost of the upgrade) first
+        self.levels[:] = level
+        if level < len(RESOLUTIONS) - 1:
+            cost = objects*( RESOLUTIONS[level+1] - RESOLUTIONS[level] )
+            order = np.argsort( cost, kind='mergesort' )
+            room = budget - RESOLUTIONS[level]*objects.sum()
+            k = np.searchsorted( np.cumsum( cost[order] ), room, 'right' )
+            self.levels[ order[:k] ] = level + 1
+        return self.levels
+
+class UniformAllocator( Allocator ):
+    # The highest level that fits the budget, the same for all engines
+    def work( self, y ):
+        objects = self.objects( y )
+        totals = RESOLUTIONS*objects.sum()
+        level = max( 0, np.searchsorted( totals, self.budget, 'right' ) - 1 )
+        self.levels[:] = level
+        return self.levels
+
+class GreedyAllocator( Allocator ):
+    # The highest level that fits for all engines, then upgrades to the
+    # next level for as many engines as still fit
+    def work( self, y ):
+        objects = self.objects( y )
+        totals = RESOLUTIONS*objects.sum()
+        level = max( 0, np.searchsorted( totals, self.budget, 'right' ) - 1 )
+        return self.fill( objects, level, self.budget )
+
+class FeedbackAllocator( Allocator ):
+    # Feedback on total memory use only, as in closedloop(): a deadzone
+    # on the log of the ratio of target to use moves a common quality
+    # index q (0..4) up or down by step; engines get level floor(q), and
+    # the fraction frac(q) of them (fewest objects first) the next level.
+    # The target is below the budget, so that the deadzone ends at it.
+    def __init__( self, budget, n, deadzone=0.05, step=0.02 ):
+        Allocator.__init__( self, budget, n )
+        self.c = DeadzoneController( deadzone )
+        self.target = math.log( budget ) - deadzone
+        self.step = step
+        self.q = 0.0
+
+    def work( self, y ):
+        objects = self.objects( y )
+        total = y.sum()
+
+        e = self.target - math.log( total ) if total > 0 else 1
+        self.q = max( 0.0, min( self.q + self.step*self.c.work( e ), 4.0 ) )
+
+        level = int( self.q )
+        k = int( round( ( self.q - level )*len(objects) ) )
+        self.levels[:] = level
+        if k:
+            self.levels[ np.argsort( objects, kind='mergesort' )[:k] ] = level + 1
+        return self.levels
+
+def fleet( n=500, policy=GreedyAllocator, budget=None, tm=5000, seed=1,
+           quiet=False ):
+    # n engines, one memory budget (default: 400 per object for 25 objects
+    # per engine). Prints per step: total memory use, budget, mean level.
+    # Returns steps over budget, mean utilization, mean level, steps/sec.
+    if budget is None: budget = 400*25*n
+
+    p = GameFleet( n, seed )
+    c = policy( budget, n )
+
+    y = np.zeros( n, dtype=int )    # no objects yet
+    over, used, quality = 0, 0.0, 0.0
+
+    start = time.time()
+    for t in range( tm ):
+        u = c.work( y )
+        y = p.work( u )
+
+        total = y.sum()
+        over += total > budget
+        used += float( total )/budget
+        quality += u.mean()
+
+        if not quiet:
+            print t, total, budget, u.mean()
+
+    return over, used/tm, quality/tm, tm/( time.time() - start )
+
+def policies( n=500, tm=5000 ):
+    # Allocation policies compared, on the same engines (same seed)
+    print "# policy steps_over_budget utilization mean_level steps/s"
+    for policy in [ UniformAllocator, GreedyAllocator, FeedbackAllocator ]:
+        over, used, quality, rate = fleet( n, policy, tm=tm, quiet=True )
+        print policy.__name__, over, used, quality, int( rate )
+
+
+# ============================================================
+
+DT = 1 # Sampling interval of the scenarios
+
+# closedloop() takes the sampling interval dt, the source of random numbers
+# rng (random module, or a fb.RandomStream), and the sink for its output
+# (stdout if None), so that it can also run side by side with others
+
+def closedloop( dt=DT, rng=random, sink=None ):
     def setpoint(t):
         return 3.5*math.log( 10.0 )
 
     c = DeadzoneController( 0.5*math.log(8.0) )
-    p = GameEngine()
+    p = GameEngine( rng )
 
     fb.closed_loop( setpoint, c, p,actuator=ConstrainingIntegrator(),
-                    returnfilter=Logarithm() )
+                    returnfilter=Logarithm(), dt=dt, sink=sink )
+
+
+if __name__ == '__main__':
+
+    fb.DT = DT
+
+    closedloop()
+
+    # fleet()
+    # policies()
 
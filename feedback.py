@@ -1,12 +1,24 @@
 
+import sys
+import copy
 import math
+import array
+import bisect
 import random
+import multiprocessing
+from collections import deque, namedtuple
 
 DT = None # Sampling interval - defaults to None, must be set explicitly
+          # (or passed to the loop functions, as dt)
 
 # ============================================================
 # Components
 
+def _shared():
+    # Deepcopy memo: the random module (the default rng of the plants) is
+    # shared, not copied; its state is saved by Checkpoint
+    return { id( random ): random }
+
 class Component:
     def work( self, u ):
         return u
@@ -14,6 +26,29 @@ class Component:
     def monitoring( self ):
         return ""  # Overload, to include addtl monitoring info in output
 
+    def snapshot( self ):
+        return copy.deepcopy( self.__dict__, _shared() ) # incl nested ones
+
+    def restore( self, state ):
+        self.__dict__.clear()
+        self.__dict__.update( copy.deepcopy( state, _shared() ) )
+
+    # Sampling interval: components use self.dt, which the loop functions
+    # set (with bind) to the dt of their loop; until then, it is DT
+
+    def bind( self, dt ):
+        self.dt = dt
+        for v in self.__dict__.values():    # nested components, too
+            for c in ( v if isinstance( v, list ) else [ v ] ):
+                if isinstance( c, Component ) and c.__dict__.get( 'dt' ) != dt:
+                    c.bind( dt )
+        return self
+
+    def __getattr__( self, name ):
+        if name == 'dt':
+            return DT
+        raise AttributeError( name )
+
 # ============================================================
 # Controllers
 
@@ -27,8 +62,8 @@ class PidController( Component ):
         self.prev = 0
 
     def work( self, e ):
-        self.i += DT*e
-        self.d = ( e - self.prev )/DT
+        self.i += self.dt*e
+        self.d = ( e - self.prev )/self.dt
         self.prev = e
 
         return self.kp*e + self.ki*self.i + self.kd*self.d
@@ -47,9 +82,9 @@ class AdvController( Component ):
     
     def work( self, e ):
         if self.unclamped:
-            self.i += DT*e
+            self.i += self.dt*e
             
-        self.d = self.alpha*(e - self.prev)/DT + (1.0-self.alpha)*self.d
+        self.d = self.alpha*(e - self.prev)/self.dt + (1.0-self.alpha)*self.d
 
         u = self.kp*e + self.ki*self.i + self.kd*self.d
 
@@ -93,7 +128,7 @@ class DeadbandRelayController( Component ):
 class HysteresisRelayController( Component ):
     def __init__( self, zone ):
         self.zone = zone
-        self.prev = None
+        self.prev = 0
 
     def work( self, e ):
         
@@ -123,7 +158,7 @@ class Boiler( Component ):
         self.g = g      # constant of proportionality (time constant)
 
     def work( self, u ):
-        self.y += DT*( -self.g*self.y + u )
+        self.y += self.dt*( -self.g*self.y + u )
         return self.y
 
 class Spring( Component ):
@@ -139,8 +174,8 @@ class Spring( Component ):
 
     def work( self, u ):
         a = ( - self.k*self.x - self.g*self.v + u )/self.m
-        self.v += DT*a
-        self.x += DT*self.v
+        self.v += self.dt*a
+        self.x += self.dt*self.v
         return self.x
 
 # ============================================================
@@ -184,20 +219,25 @@ class Integrator( Component ):
 
     def work( self, u ):
         self.data += u
-        return DT*self.data
+        return self.dt*self.data
 
 class FixedFilter( Component ):
     def __init__( self, n ):
         self.n = n
-        self.data = []
+        self.data = [ 0.0 ]*n # ring buffer, preallocated
+        self.k = 0            # number of samples seen
+        self.total = 0.0      # running sum of the samples in the buffer
 
     def work( self, x ):
-        self.data.append(x)
+        slot = self.k % self.n
+        self.total += x - self.data[slot]
+        self.data[slot] = x
+        self.k += 1
 
-        if len(self.data) > self.n:
-            self.data.pop(0)
+        if slot == self.n-1:  # re-sum once per cycle, to limit float drift
+            self.total = float(sum(self.data))
 
-        return float(sum(self.data))/len(self.data)
+        return self.total/min( self.k, self.n )
 
 class RecursiveFilter( Component ):
     def __init__( self, alpha ):
@@ -208,11 +248,227 @@ class RecursiveFilter( Component ):
         self.y = self.alpha*x + (1-self.alpha)*self.y
         return self.y
 
+# --- Streaming window filters: over the last n samples, like FixedFilter
+
+class MovingMedian( Component ):
+    # Sorted window: finding a sample is O(log n), but inserting and
+    # deleting it move O(n) list entries (a memmove). That is faster than
+    # heaps with lazy deletion up to windows of several 10000 samples.
+    def __init__( self, n ):
+        self.n = n
+        self.data = [ 0.0 ]*n # ring buffer, in arrival order
+        self.k = 0
+        self.window = []      # same samples, sorted
+
+    def work( self, x ):
+        slot = self.k % self.n
+        if self.k >= self.n:  # remove oldest sample: binary search
+            del self.window[ bisect.bisect_left( self.window, self.data[slot] ) ]
+        self.data[slot] = x
+        self.k += 1
+
+        bisect.insort( self.window, x )
+
+        m = len(self.window)
+        if m%2 == 1:
+            return self.window[m//2]
+        return 0.5*( self.window[m//2-1] + self.window[m//2] )
+
+class MovingMin( Component ):
+    def __init__( self, n ):
+        self.n = n
+        self.k = 0
+        self.window = deque() # (index, value), values increasing
+
+    def work( self, x ):
+        while self.window and not self._keep( self.window[-1][1], x ):
+            self.window.pop() # can never be the extremum again
+        self.window.append( (self.k, x) )
+
+        if self.window[0][0] <= self.k - self.n: # dropped out of window
+            self.window.popleft()
+        self.k += 1
+
+        return self.window[0][1]
+
+    def _keep( self, old, new ):
+        return old < new
+
+class MovingMax( MovingMin ):
+    def _keep( self, old, new ):
+        return old > new
+
+class MovingVariance( Component ):
+    def __init__( self, n ):
+        self.n = n
+        self.data = [ 0.0 ]*n # ring buffer
+        self.k = 0
+        self.mean = 0.0
+        self.m2 = 0.0         # sum of squared deviations from the mean
+
+    def work( self, x ):
+        slot = self.k % self.n
+
+        if self.k < self.n:   # window filling up: Welford update
+            m = self.k + 1
+            delta = x - self.mean
+            self.mean += delta/m
+            self.m2 += delta*( x - self.mean )
+        else:                 # window full: replace oldest sample
+            m = self.n
+            old, mean = self.data[slot], self.mean
+            self.mean += float( x - old )/m
+            self.m2 += ( x - old )*( x - self.mean + old - mean )
+
+        self.data[slot] = x
+        self.k += 1
+
+        if slot == self.n-1:  # recompute once per cycle, to limit drift
+            self.mean = float(sum(self.data))/self.n
+            self.m2 = sum( (d - self.mean)**2 for d in self.data )
+
+        return max( 0.0, self.m2/m )
+
+# ============================================================
+# Multi-rate loops
+
+class Sampled( Component ):
+    # Runs component only every period (in time units, a multiple of the
+    # loop's dt), and holds its output in between (zero-order hold). The
+    # component sees period as its dt: eg, a controller sampled once per
+    # second integrates over one second per call. The first call is after
+    # offset (also in time units).
+
+    def __init__( self, component, period, offset=0 ):
+        if period <= 0 or offset < 0:
+            raise ValueError( "Need period > 0 and offset >= 0" )
+        self.component = component
+        self.period = period
+        self.offset = offset
+        self.every = None     # steps per call, set by bind()
+        self.k = None         # steps until the next call, set by bind()
+        self.y = 0
+
+    def bind( self, dt ):
+        self.dt = dt
+        self.every = max( 1, int( round( self.period/float( dt ) ) ) )
+        if self.k is None:    # not yet started
+            self.k = int( round( self.offset/float( dt ) ) )
+        self.component.bind( self.every*dt )
+        return self
+
+    def work( self, u ):
+        if self.every is None: self.bind( self.dt )
+        if self.k == 0:
+            self.y = self.component.work( u )
+            self.k = self.every
+        self.k -= 1
+        return self.y
+
+# ============================================================
+# Random numbers
+
+class RandomStream:
+    # Random numbers with the interface of the random module (the parts
+    # used by the plants), from a generator of its own: give each plant
+    # a stream, instead of sharing the global state of the random module.
+    # Variates are generated by NumPy in blocks, and handed out one at a
+    # time (without NumPy, they come from a random.Random).
+    #
+    # Streams with the same seed and different keys are independent, so
+    # for reproducible parallel runs, use the run index as key:
+    #
+    #   p = AdPublisher( 100, 2, rng=RandomStream( seed, k ) )
+
+    def __init__( self, seed=None, key=0, block=4096 ):
+        self.block = block
+        self.seed( seed, key )
+
+    def seed( self, seed=None, key=0 ):
+        # seed=None: seeded from the OS, also in forked processes
+        try:
+            import numpy
+            self.np = numpy.random.RandomState( None if seed is None
+                                                else [ seed, key ] )
+        except ImportError:
+            self.np = None
+            self.py = random.Random( None if seed is None else ( seed, key ) )
+
+        self.uniforms, self.normals, self.exponentials = [], [], []
+        self.betas = {}
+
+    def _draw( self, name, *args ):
+        if self.np is not None:
+            return getattr( self.np, name )( *( args + (self.block,) ) ).tolist()
+
+        draw = _FALLBACK[name]
+        return [ draw( self.py, *args ) for _ in range( self.block ) ]
+
+    def random( self ):
+        try:
+            return self.uniforms.pop()
+        except IndexError:
+            self.uniforms = self._draw( 'random_sample' )
+            return self.uniforms.pop()
+
+    # These use random(), but try its fast path inline first
+
+    def uniform( self, a, b ):
+        try:
+            return a + ( b - a )*self.uniforms.pop()
+        except IndexError:
+            return a + ( b - a )*self.random()
+
+    def randint( self, a, b ):
+        try:
+            return a + int( ( b - a + 1 )*self.uniforms.pop() )
+        except IndexError:
+            return a + int( ( b - a + 1 )*self.random() )
+
+    def choice( self, seq ):
+        try:
+            return seq[ int( len(seq)*self.uniforms.pop() ) ]
+        except IndexError:
+            return seq[ int( len(seq)*self.random() ) ]
+
+    def gauss( self, mu, sigma ):
+        try:
+            return mu + sigma*self.normals.pop()
+        except IndexError:
+            self.normals = self._draw( 'standard_normal' )
+            return mu + sigma*self.normals.pop()
+
+    normalvariate = gauss
+
+    def expovariate( self, lambd ):
+        try:
+            return self.exponentials.pop()/lambd
+        except IndexError:
+            self.exponentials = self._draw( 'standard_exponential' )
+            return self.exponentials.pop()/lambd
+
+    def betavariate( self, alpha, beta ):
+        buf = self.betas.get( (alpha, beta) )
+        if not buf:
+            buf = self.betas[ (alpha, beta) ] = self._draw( 'beta', alpha, beta )
+        return buf.pop()
+
+    def betavariates( self, alpha, beta, n ):
+        # n draws at once, as a list (or a NumPy array, with NumPy)
+        if self.np is not None:
+            return self.np.beta( alpha, beta, n )
+        return [ self.py.betavariate( alpha, beta ) for _ in range( n ) ]
+
+_FALLBACK = { 'random_sample': lambda r: r.random(),
+              'standard_normal': lambda r: r.gauss( 0, 1 ),
+              'standard_exponential': lambda r: r.expovariate( 1 ),
+              'beta': lambda r, a, b: r.betavariate( a, b ) }
+
 # ============================================================
 # Setpoints
 
 def impulse( t, t0 ):
-    if abs(t-t0) < DT: return 1 # Floating point or integer time?
+    if t == t0: return 1 # Setpoints are called with the step index t
     return 0
 
 def step( t, t0 ):
@@ -245,47 +501,62 @@ def relay( t, t0, tp ):
 # def setpoint( t ):
 #   return step( t, 0 )
 
-def static_test( plant_ctor, ctor_args, umax, steps, repeats, tmax ):
-    # Complete test for static process characteristic
-    # From u=0 to umax taking steps steps, each one repeated repeats
-    
+# --- Step records: one per simulation step, same columns as printed
+
+Step = namedtuple( 'Step', 't time r e u v y z monitoring' )
+Static = namedtuple( 'Static', 'u y' )
+
+def bind( dt, components ):
+    # Sets the sampling interval of a loop (DT, unless dt is given) on its
+    # components, and returns it
+    if dt is None: dt = DT
+    if dt is not None:
+        for c in components:
+            if isinstance( c, Component ): c.bind( dt )
+    return dt
+
+def iter_static_test( plant_ctor, ctor_args, umax, steps, repeats, tmax,
+                      dt=None ):
     for i in range( 0, steps ):
         u = float(i)*umax/float(steps)
 
         for r in range( repeats ):
             p = apply( plant_ctor, ctor_args ) # this is: p = Plant( a, b, c )
+            bind( dt, [ p ] )
 
             for t in range( tmax ):
                 y = p.work(u)
 
-            print u, y
-            
-    quit()
+            yield Static( u, y )
 
-def step_response( setpoint, plant, tm=5000 ):
-    for t in range( tm ):
+def iter_step_response( setpoint, plant, tm=5000, monitor=True, start=0,
+                        dt=None ):
+    dt = bind( dt, [ plant ] )
+    for t in range( start, start+tm ):
         r = setpoint(t)  # This is the plant input, not really the setpoint!
         u = r
         y = plant.work( u )
 
-        print t, t*DT, r, 0, u, u, y, y, plant.monitoring()
-        
-    quit()
+        m = plant.monitoring() if monitor else ""
+        yield Step( t, t*dt, r, 0, u, u, y, y, m )
 
-def open_loop( setpoint, controller, plant, tm=5000 ):
-    for t in range( tm ):
+def iter_open_loop( setpoint, controller, plant, tm=5000, monitor=True,
+                    start=0, dt=None ):
+    dt = bind( dt, [ controller, plant ] )
+    for t in range( start, start+tm ):
         r = setpoint(t)  # This is the controller input, not really the setpt!
         u = controller.work( r )
         y = plant.work( u )
 
-        print t, t*DT, r, 0, u, u, y, y, plant.monitoring()
-
-    quit()
+        m = plant.monitoring() if monitor else ""
+        yield Step( t, t*dt, r, 0, u, u, y, y, m )
 
-def closed_loop( setpoint, controller, plant, tm=5000, inverted=False,
-                 actuator=Identity(), returnfilter=Identity() ):
-    z = 0
-    for t in range( tm ):
+def iter_closed_loop( setpoint, controller, plant, tm=5000, inverted=False,
+                      actuator=Identity(), returnfilter=Identity(),
+                      monitor=True, start=0, z=0, dt=None ):
+    # start, z: to continue a run from step start, with return value z
+    dt = bind( dt, [ controller, actuator, plant, returnfilter ] )
+    for t in range( start, start+tm ):
         r = setpoint(t)
         e = r - z
         if inverted == True: e = -e
@@ -294,8 +565,171 @@ def closed_loop( setpoint, controller, plant, tm=5000, inverted=False,
         y = plant.work(v)
         z = returnfilter.work(y)
 
-        print t, t*DT, r, e, u, v, y, z, plant.monitoring()
+        m = plant.monitoring() if monitor else ""
+        yield Step( t, t*dt, r, e, u, v, y, z, m )
+
+# --- Sinks: consumers for step records
+
+class NullSink:
+    def write( self, rec ):
+        pass
+
+    def close( self ):
+        pass
+
+class FileSink:
+    # Writes records as whitespace-separated lines, like the print statements
+    def __init__( self, f ):
+        if isinstance( f, basestring ):
+            f = open( f, 'w' )
+        self.f = f
+
+    def write( self, rec ):
+        self.f.write( " ".join( map( str, rec ) ) + "\n" )
+
+    def close( self ):
+        if self.f is not sys.stdout:
+            self.f.close()
+
+class ArraySink:
+    # Collects each column in memory: numbers in arrays, strings in lists
+    def __init__( self ):
+        self.columns = None
+
+    def write( self, rec ):
+        if self.columns is None:
+            self.fields = rec._fields
+            self.columns = [ array.array( 'd' ) if _numeric(x) else []
+                             for x in rec ]
+
+        for c, x in zip( self.columns, rec ):
+            c.append( x )
+
+    def close( self ):
+        pass
+
+    def __getitem__( self, field ):
+        return self.columns[ self.fields.index( field ) ]
+
+def _numeric( x ):
+    return isinstance( x, (int, long, float) ) and not isinstance( x, bool )
+
+def drain( records, sink ):
+    for rec in records:
+        sink.write( rec )
+    sink.close()
+    return sink
+
+# --- Checkpoints: branch many runs from one warmed-up system
+
+class Checkpoint:
+    # State of some components and of the random number generators (the
+    # random module, and NumPy's if it is in use), and the loop state
+    # (step t, return value z) to continue from
+
+    def __init__( self, components, t=0, z=0 ):
+        self.states = [ c.snapshot() for c in components ]
+        self.random = random.getstate()
+        self.t, self.z = t, z
+
+        np = sys.modules.get( 'numpy' )
+        self.nprandom = np.random.get_state() if np else None
+
+    def restore( self, components ):
+        for c, state in zip( components, self.states ):
+            c.restore( state )
+        random.setstate( self.random )
+
+        if self.nprandom is not None:
+            sys.modules['numpy'].random.set_state( self.nprandom )
+
+def branch( checkpoint, components, variants, continuation, processes=1 ):
+    # Calls continuation( variant ) for each variant, each time after the
+    # components have been restored from the checkpoint. All branches see
+    # the same random numbers, unless the continuation reseeds.
+    # With processes other than 1, branches run in a (fork-based) process
+    # pool: the warmed-up system is inherited, only variants and results
+    # are pickled.
+
+    if processes == 1:
+        return [ _branch_run( v, ( checkpoint, components, continuation ) )
+                 for v in variants ]
+
+    global _branch
+    _branch = ( checkpoint, components, continuation )
+
+    try:
+        pool = multiprocessing.Pool( processes )
+        try:
+            return pool.map( _branch_run, variants )
+        finally:
+            pool.terminate()
+    finally:
+        _branch = None
+
+_branch = None
+
+def _branch_run( variant, task=None ):
+    checkpoint, components, continuation = task or _branch
+    checkpoint.restore( components )
+    return continuation( variant )
+
+def run_concurrently( scenarios, threads=None ):
+    # Runs scenarios (functions without arguments) in a pool of threads,
+    # and returns their results in order. Results are the same as for
+    # sequential runs if each scenario passes dt to the loop functions
+    # (instead of setting DT), and its plants draw from RandomStreams of
+    # their own, and output goes to a sink per scenario (the sink argument
+    # of the loop functions). Scenarios that end in one of the loop
+    # functions below (which quit) return None.
+    from multiprocessing.pool import ThreadPool
+
+    pool = ThreadPool( threads or len( scenarios ) )
+    try:
+        return pool.map( _run_scenario, scenarios )
+    finally:
+        pool.terminate()
+
+def _run_scenario( scenario ):
+    # SystemExit would end the worker thread, and map() would never return
+    try:
+        return scenario()
+    except SystemExit:
+        return None
+
+# --- Loop functions: print every step (or write to sink), then quit
+
+# The sink: the sink argument, else stdout. Loops that run concurrently
+# should each pass a sink of their own.
+
+def _sink( sink=None ):
+    if sink is None:
+        return FileSink( sys.stdout )
+    return sink
+
+def static_test( plant_ctor, ctor_args, umax, steps, repeats, tmax,
+                 dt=None, sink=None ):
+    # Complete test for static process characteristic
+    # From u=0 to umax taking steps steps, each one repeated repeats
+    
+    drain( iter_static_test( plant_ctor, ctor_args, umax, steps, repeats,
+                             tmax, dt ), _sink( sink ) )
+    quit()
+
+def step_response( setpoint, plant, tm=5000, dt=None, sink=None ):
+    drain( iter_step_response( setpoint, plant, tm, dt=dt ), _sink( sink ) )
+    quit()
+
+def open_loop( setpoint, controller, plant, tm=5000, dt=None, sink=None ):
+    drain( iter_open_loop( setpoint, controller, plant, tm, dt=dt ),
+           _sink( sink ) )
+    quit()
 
+def closed_loop( setpoint, controller, plant, tm=5000, inverted=False,
+                 actuator=Identity(), returnfilter=Identity(), dt=None,
+                 sink=None ):
+    drain( iter_closed_loop( setpoint, controller, plant, tm, inverted,
+                             actuator, returnfilter, dt=dt ), _sink( sink ) )
     quit()
 
 # ============================================================
@@ -0,0 +1,349 @@
+
+import time
+import array
+import feedback as fb
+
+# Fused loops: a loop is declared as a block graph and compiled into a
+# single Python function that runs many steps. Identity blocks are dropped,
+# the work() of common components is inlined with their state held in
+# local variables (and written back to the components when the run ends),
+# and parameters and dt are loaded once per run instead of once per step.
+#
+#   loop = Loop( setpoint, controller, plant, actuator, returnfilter )
+#   cols = fuse( loop, channels=('t','y') ).run( 10000 )
+#
+# A cascade (inner loop used as the plant of an outer loop) is declared
+# with Inner. Results match fb.closed_loop() step for step.
+
+# ============================================================
+# Block graphs
+
+class Loop:
+    def __init__( self, setpoint, controller, plant, actuator=None,
+                  returnfilter=None, inverted=False, dt=None ):
+        self.setpoint = setpoint
+        self.controller = controller
+        self.actuator = actuator
+        self.plant = plant
+        self.returnfilter = returnfilter
+        self.inverted = inverted
+        self.dt = dt         # sampling interval; fb.DT if None
+
+        self.t = 0           # loop state, carried over between runs
+        self.z = 0
+
+    def bind( self ):
+        return fb.bind( self.dt, [ self.controller, self.actuator,
+                                   self.plant, self.returnfilter ] )
+
+class Inner( fb.Component ):
+    # Closed loop used as a plant: its setpoint is the control input of
+    # the outer loop. Its output is the plant output y, or the plant
+    # attribute named by output (eg 'queue'). Can also be used as an
+    # ordinary component.
+
+    def __init__( self, controller, plant, actuator=None, returnfilter=None,
+                  inverted=False, output=None ):
+        self.controller = controller
+        self.actuator = actuator
+        self.plant = plant
+        self.returnfilter = returnfilter
+        self.inverted = inverted
+        self.output = output
+
+        self.z = 0
+
+    def work( self, u ):
+        e = u - self.z
+        if self.inverted == True: e = -e
+        u = _work( self.controller, e )
+        v = _work( self.actuator, u )
+        y = self.plant.work( v )
+        self.z = _work( self.returnfilter, y )
+
+        if self.output is None:
+            return y
+        return getattr( self.plant, self.output )
+
+def _work( c, x ):
+    if c is None: return x
+    return c.work( x )
+
+# ============================================================
+# Code generation
+
+class _Generator:
+    def __init__( self ):
+        self.env = { 'xrange': xrange, 'fb': fb }
+        self.setup = []      # before the loop: load state into locals
+        self.body = []       # once per step
+        self.teardown = []   # after the loop: write state back
+        self.locals = {}     # (id of object, attribute): local that holds it
+        self.count = 0
+
+    def bind( self, obj ):
+        self.count += 1
+        name = "b%d" % self.count
+        self.env[name] = obj
+        return name, name + "_"  # object name, prefix for its locals
+
+    def state( self, o, p, attrs ):
+        # Keep attributes attrs of object o in locals p+attr during the run
+        for a in attrs:
+            self.setup.append( "%s%s = %s.%s" % ( p, a, o, a ) )
+            self.locals[ ( id( self.env[o] ), a ) ] = p + a
+        for a in attrs:
+            self.teardown.append( "%s.%s = %s%s" % ( o, a, p, a ) )
+
+    def block( self, c, x, indent ):
+        # Emit code that feeds variable x through component c;
+        # returns the name of the variable that holds the output
+
+        if c is None or c.__class__ is fb.Identity:
+            return x
+
+        o, p = self.bind( c )
+        out = p + "out"
+        add = lambda line: self.body.append( indent + line % { 'x':x, 'p':p,
+                                                               'o':o, 'out':out } )
+        cls = c.__class__
+
+        if cls is fb.PidController:
+            self.state( o, p, ( 'kp', 'ki', 'kd', 'i', 'd', 'prev' ) )
+            add( "%(p)si += DT*%(x)s" )
+            add( "%(p)sd = ( %(x)s - %(p)sprev )/DT" )
+            add( "%(p)sprev = %(x)s" )
+            add( "%(out)s = %(p)skp*%(x)s + %(p)ski*%(p)si + %(p)skd*%(p)sd" )
+
+        elif cls is fb.AdvController:
+            self.state( o, p, ( 'kp', 'ki', 'kd', 'i', 'd', 'prev',
+                                'unclamped', 'clamp_lo', 'clamp_hi', 'alpha' ) )
+            add( "if %(p)sunclamped: %(p)si += DT*%(x)s" )
+            add( "%(p)sd = %(p)salpha*(%(x)s - %(p)sprev)/DT + " +
+                 "(1.0-%(p)salpha)*%(p)sd" )
+            add( "%(out)s = %(p)skp*%(x)s + %(p)ski*%(p)si + %(p)skd*%(p)sd" )
+            add( "%(p)sunclamped = ( %(p)sclamp_lo < %(out)s < %(p)sclamp_hi )" )
+            add( "%(p)sprev = %(x)s" )
+
+        elif cls is fb.Limiter:      # same as max( lo, min( x, hi ) )
+            self.state( o, p, ( 'lo', 'hi' ) )
+            add( "%(out)s = %(p)shi if %(p)shi < %(x)s else %(x)s" )
+            add( "if not %(out)s > %(p)slo: %(out)s = %(p)slo" )
+
+        elif cls is fb.RecursiveFilter:
+            self.state( o, p, ( 'alpha', 'y' ) )
+            self.setup.append( "%sbeta = 1-%salpha" % ( p, p ) )
+            add( "%(p)sy = %(p)salpha*%(x)s + %(p)sbeta*%(p)sy" )
+            out = p + "y"
+
+        elif cls is fb.Boiler:
+            self.state( o, p, ( 'g', 'y' ) )
+            add( "%(p)sy += DT*( -%(p)sg*%(p)sy + %(x)s )" )
+            out = p + "y"
+
+        elif cls is fb.Integrator:
+            self.state( o, p, ( 'data', ) )
+            add( "%(p)sdata += %(x)s" )
+            add( "%(out)s = DT*%(p)sdata" )
+
+        elif isinstance( c, Inner ):
+            self.setup.append( "%sz = %s.z" % ( p, o ) )
+            self.teardown.append( "%s.z = %sz" % ( o, p ) )
+
+            add( "%(p)se = %(x)s - %(p)sz" )
+            if c.inverted == True:
+                add( "%(p)se = -%(p)se" )
+            u = self.block( c.controller, p + "e", indent )
+            v = self.block( c.actuator, u, indent )
+            y = self.block( c.plant, v, indent )
+            z = self.block( c.returnfilter, y, indent )
+            add( "%(p)sz = " + z )
+
+            if c.output is None:
+                out = y
+            elif ( id( c.plant ), c.output ) in self.locals: # inlined plant
+                out = self.locals[ ( id( c.plant ), c.output ) ]
+            else:
+                plant, _ = self.bind( c.plant )
+                add( "%(out)s = " + plant + "." + c.output )
+
+        else:                        # anything else: call work()
+            self.setup.append( "%swork = %s.work" % ( p, o ) )
+            add( "%(out)s = %(p)swork( %(x)s )" )
+
+        return out
+
+def fuse( loop, channels=(), monitor=False ):
+    # Channels to record: any of t, time, r, e, u, v, y, z (and monitoring,
+    # if monitor is set: the plant's monitoring() output, as a string)
+
+    g = _Generator()
+    L, _ = g.bind( loop )
+    ind = " "*12
+
+    g.body.append( ind + "r = setpoint( t )" )
+    g.body.append( ind + "e = r - z" )
+    if loop.inverted == True:
+        g.body.append( ind + "e = -e" )
+
+    names = { 'r': 'r', 'e': 'e', 't': 't', 'time': 't*DT' }
+    names['u'] = g.block( loop.controller, 'e', ind )
+    names['v'] = g.block( loop.actuator, names['u'], ind )
+    names['y'] = g.block( loop.plant, names['v'], ind )
+    names['z'] = g.block( loop.returnfilter, names['y'], ind )
+    g.body.append( ind + "z = " + names['z'] )
+
+    if monitor:
+        plant, _ = g.bind( loop.plant )
+        names['monitoring'] = plant + ".monitoring()"
+
+    for c in channels:
+        g.setup.append( "%s_append = cols['%s'].append" % ( c, c ) )
+        g.body.append( ind + "%s_append( %s )" % ( c, names[c] ) )
+
+    src = [ "def run( tm, cols ):",
+            "    DT = %s.bind()" % L,
+            "    setpoint = %s.setpoint" % L,
+            "    t, z = %s.t - 1, %s.z" % ( L, L ) ]
+    src += [ "    " + line for line in g.setup ]
+    src += [ "    try:",
+             "        for t in xrange( %s.t, %s.t + tm ):" % ( L, L ) ]
+    src += g.body
+    src += [ "    finally:",
+             "        %s.t, %s.z = t + 1, z" % ( L, L ) ]
+    src += [ "        " + line for line in g.teardown ]
+
+    source = "\n".join( src ) + "\n"
+    exec source in g.env
+
+    return Fused( g.env['run'], channels, source )
+
+class Fused:
+    def __init__( self, run, channels, source ):
+        self._run = run
+        self.channels = channels
+        self.source = source # generated code, for inspection
+
+    def run( self, tm ):
+        cols = {}
+        for c in self.channels:
+            cols[c] = [] if c == 'monitoring' else array.array( 'd' )
+
+        self._run( tm, cols )
+        return cols
+
+# ============================================================
+# Benchmark
+
+def _scenarios():
+    # (name, DT, steps, factory): the factory returns a fresh Loop
+    import math, imp
+    ch13 = imp.load_source( 'ch13', 'ch13-cache.py' )
+    ch14 = imp.load_source( 'ch14', 'ch14-adserving.py' )
+    ch15 = imp.load_source( 'ch15', 'ch15-ch16-serverpool-and-queue.py' )
+    ch17 = imp.load_source( 'ch17', 'ch17-fancontrol.py' )
+    ch18 = imp.load_source( 'ch18', 'ch18-gameengine.py' )
+
+    def cache():             # ch13 closedloop_jumps()
+        import random
+        def demand( t ):
+            if t < 3000:
+                return int( random.gauss( 0, 15 ) )
+            elif t < 5000:
+                return int( random.gauss( 0, 35 ) )
+            else:
+                return int( random.gauss( 100, 15 ) )
+
+        return Loop( lambda t: 0.7, fb.PidController( 270, 7.5 ),
+                     ch13.SmoothedCache( 0, demand, 100 ) )
+
+    def adserving():         # ch14 closedloop( 0.5, 0.25 )
+        def setpoint( t ):
+            if t > 1000:
+                return 125
+            return 100
+
+        k = 1.0/20.0
+        return Loop( setpoint, fb.PidController( k*0.5, k*0.25 ),
+                     ch14.AdPublisher( 100, 2 ) )
+
+    def serverpool():        # ch15 closedloop1()
+        loadqueue = ch15.QueueLoad( [ (2100, 1200) ] )
+
+        def setpoint( t ):
+            if t > 2000:
+                return 0.6
+            return 0.8
+
+        return Loop( setpoint, fb.PidController( 1, 5 ),
+                     ch15.ServerPool( 8, ch15.consume_queue, loadqueue ) )
+
+    def nestedloops():       # ch15 nestedloops(), inner loop as a cascade
+        k = 1/100.
+        inner = Inner( fb.PidController( 0.5*k, 0.25*k ),
+                       ch15.QueueingServerPool( 0, ch15.consume_queue,
+                                                ch15.QueueLoad() ),
+                       inverted=True, output='queue' )
+
+        return Loop( lambda t: 200,
+                     fb.AdvController( 0.35, 0.0025, 4.5, smooth=0.15 ),
+                     inner, actuator=fb.RecursiveFilter( 0.5 ) )
+
+    def fancontrol():        # ch17 production()
+        def setpoint( t ):
+            if t*0.01 < 6*60: return 50
+            else: return 45
+
+        p = ch17.CpuWithCooler( True, True ); p.temp = 50
+        return Loop( setpoint, fb.AdvController( 2, 0.5, 0, clamp=(0,10) ),
+                     p, actuator=fb.Limiter( 0, 10 ), inverted=True )
+
+    def gameengine():        # ch18
+        return Loop( lambda t: 3.5*math.log( 10.0 ),
+                     ch18.DeadzoneController( 0.5*math.log( 8.0 ) ),
+                     ch18.GameEngine(),
+                     actuator=ch18.ConstrainingIntegrator(),
+                     returnfilter=ch18.Logarithm() )
+
+    return [ ( 'ch13-cache', 1, 10000, cache ),
+             ( 'ch14-adserving', 1, 5000, adserving ),
+             ( 'ch15-closedloop1', 1, 10000, serverpool ),
+             ( 'ch15-nestedloops', 1, 5000, nestedloops ),
+             ( 'ch17-production', 0.01, 100000, fancontrol ),
+             ( 'ch18-gameengine', 1, 5000, gameengine ) ]
+
+def _closed_loop( loop, tm ):
+    # Reference: the generator-based loop function, output discarded
+    records = fb.iter_closed_loop( loop.setpoint, loop.controller, loop.plant,
+                                   tm, loop.inverted,
+                                   loop.actuator or fb.Identity(),
+                                   loop.returnfilter or fb.Identity(),
+                                   monitor=False, dt=loop.dt )
+    return [ rec.y for rec in records ]
+
+def benchmark( seed=1 ):
+    import random
+
+    print "# scenario steps closed_loop_steps/s fused_steps/s speedup identical"
+    for name, dt, tm, factory in _scenarios():
+        random.seed( seed )
+        loop = factory()
+        loop.dt = dt
+        start = time.time()
+        ref = _closed_loop( loop, tm )
+        t1 = time.time() - start
+
+        random.seed( seed )
+        loop = factory()
+        loop.dt = dt
+        f = fuse( loop, channels=( 'y', ) )
+        start = time.time()
+        y = f.run( tm )['y']
+        t2 = time.time() - start
+
+        print name, tm, int( tm/t1 ), int( tm/t2 ), "%.2f" % ( t1/t2 ),
+        print list( y ) == [ float( x ) for x in ref ]
+
+if __name__ == '__main__':
+
+    benchmark()
@@ -0,0 +1,235 @@
+
+import numpy as np
+from collections import namedtuple
+import feedback as fb
+
+# System identification from recorded input/output arrays (for example
+# the u and y columns of a step response), and controller tuning rules
+# based on the identified models.
+#
+#   u, y = ident.columns( fb.iter_step_response( setpoint, plant, 5000 ) )
+#   model = ident.fopdt( u, y )
+#   print ident.tuning( model )
+#
+# Alternatively, relay_autotune() finds the ultimate gain and period of
+# a plant with a short relay feedback experiment.
+
+Fopdt = namedtuple( 'Fopdt', 'K T L' )             # K exp(-Ls)/(Ts+1)
+SecondOrder = namedtuple( 'SecondOrder', 'K wn zeta L' )
+Ultimate = namedtuple( 'Ultimate', 'Ku Pu amplitude steps' )
+
+def columns( records ):
+    sink = fb.drain( records, fb.ArraySink() )
+    return np.array( sink['u'] ), np.array( sink['y'] )
+
+# ============================================================
+# Models
+
+def _lagged( a, b, n ):
+    # c[d] = sum_j a[j+d]*b[j], over the j where both are defined, for
+    # d=0..n-1 (via FFT)
+    m = 1 << int( np.ceil( np.log2( len(a) + len(b) ) ) )
+    c = np.fft.irfft( np.fft.rfft( a, m )*np.conj( np.fft.rfft( b, m ) ), m )
+    return c[:n]
+
+def fopdt( u, y, dt=None, max_delay=None ):
+    # First order plus dead time. Fits y[k+1] = a y[k] + b u[k-d] + c
+    # (c absorbs offsets) by least squares, for all delays d at once,
+    # and keeps the delay with the smallest mean squared residual. All
+    # delays are fitted on the same rows, k=0..n-2: before the start of
+    # the record, u is taken to hold its first value.
+
+    if dt is None: dt = fb.DT
+    u = np.asarray( u, dtype=float )
+    y = np.asarray( y, dtype=float )
+    n = len(y)
+    if max_delay is None: max_delay = n//4
+    max_delay = min( max_delay, n-2 )
+    D = max_delay
+    d = np.arange( D + 1 )
+
+    # u padded in front: row k, delay d uses up[k+D-d]
+    up = np.concatenate( [ np.repeat( u[:1], D ), u[:n-1] ] )
+    y0, y1 = y[:-1], y[1:]
+
+    # Sums over the rows, as functions of d (prefix sums, correlations)
+    def window( x ):                    # sum of x[k+D-d] for k=0..n-2
+        s = np.concatenate( [ [0], np.cumsum( x ) ] )
+        return s[ D-d+n-1 ] - s[ D-d ]
+
+    uu, su = window( up*up ), window( up )
+    yu = _lagged( up, y0, D+1 )[ D-d ]
+    y1u = _lagged( up, y1, D+1 )[ D-d ]
+    yy, sy, y1y0, sy1 = y0.dot( y0 ), y0.sum(), y1.dot( y0 ), y1.sum()
+    count = n - 1
+
+    # Normal equations for ( a, b, c ), one 3x3 system per delay; with
+    # u constant over the rows, a system is singular (b undetermined),
+    # so take the minimum norm solutions
+    M = np.empty( (len(d), 3, 3) )
+    M[:,0,0], M[:,0,1], M[:,0,2] = yy, yu, sy
+    M[:,1,0], M[:,1,1], M[:,1,2] = yu, uu, su
+    M[:,2,0], M[:,2,1], M[:,2,2] = sy, su, count
+    g = np.column_stack( [ np.repeat( y1y0, len(d) ), y1u,
+                           np.repeat( sy1, len(d) ) ] )
+
+    theta = np.einsum( 'dij,dj->di', np.linalg.pinv( M ), g )
+
+    sse = y1.dot( y1 ) - ( theta*g ).sum( axis=1 )
+    best = int( np.argmin( sse ) )
+
+    a, b = theta[best,0], theta[best,1]
+    K = b/(1 - a)
+    T = -dt/np.log( a ) if 0 < a < 1 else np.inf
+    return Fopdt( K, T, best*dt )
+
+def second_order( u, y, dt=None, delay=None ):
+    # Fits y[k+1] = a1 y[k] + a2 y[k-1] + b1 u[k-d] + b2 u[k-d-1] + c;
+    # the delay defaults to the one found by fopdt()
+
+    if dt is None: dt = fb.DT
+    u = np.asarray( u, dtype=float )
+    y = np.asarray( y, dtype=float )
+    if delay is None:
+        delay = fopdt( u, y, dt ).L
+    d = int( round( delay/dt ) )
+
+    k = np.arange( d+1, len(y)-1 )
+    X = np.column_stack( [ y[k], y[k-1], u[k-d], u[k-d-1], np.ones( len(k) ) ] )
+    a1, a2, b1, b2, c = np.linalg.lstsq( X, y[k+1], rcond=None )[0]
+
+    K = ( b1 + b2 )/( 1 - a1 - a2 )
+
+    z = np.roots( [ 1, -a1, -a2 ] ).astype( complex ) # discrete poles
+    s = np.log( z )/dt                                  # continuous poles
+    wn = np.sqrt( abs( s[0]*s[1] ) )
+    zeta = -( s[0] + s[1] ).real/( 2*wn )
+
+    return SecondOrder( K, wn, zeta, d*dt )
+
+def frequency_response( u, y, dt=None, segments=8 ):
+    # Estimate of the frequency response from averaged spectra of the
+    # differenced signals (so that steps and offsets do no harm).
+    # Returns frequencies (Hz) and complex gains.
+
+    if dt is None: dt = fb.DT
+    du = np.diff( np.asarray( u, dtype=float ) )
+    dy = np.diff( np.asarray( y, dtype=float ) )
+
+    m = len(du)//segments
+    w = np.hanning( m )
+    U = np.fft.rfft( w*du[:m*segments].reshape( segments, m ), axis=1 )
+    Y = np.fft.rfft( w*dy[:m*segments].reshape( segments, m ), axis=1 )
+
+    H = ( Y*np.conj( U ) ).sum( axis=0 )/np.maximum( ( abs(U)**2 ).sum( axis=0 ),
+                                                    1e-300 )
+    return np.fft.rfftfreq( m, dt ), H
+
+# ============================================================
+# Tuning rules for a first order plus dead time model: (kp, ki, kd)
+
+def ziegler_nichols( m, kind='PID' ):
+    K, T, L = m
+    if kind == 'PI':
+        kp, ti, td = 0.9*T/(K*L), 3.33*L, 0
+    else:
+        kp, ti, td = 1.2*T/(K*L), 2*L, 0.5*L
+    return kp, kp/ti, kp*td
+
+def cohen_coon( m, kind='PID' ):
+    K, T, L = m
+    r = L/T
+    if kind == 'PI':
+        kp = (0.9 + r/12)/(K*r)
+        ti, td = L*(30 + 3*r)/(9 + 20*r), 0
+    else:
+        kp = (4.0/3 + r/4)/(K*r)
+        ti, td = L*(32 + 6*r)/(13 + 8*r), 4*L/(11 + 2*r)
+    return kp, kp/ti, kp*td
+
+def amigo( m, kind='PID' ):
+    K, T, L = m
+    if kind == 'PI':
+        kp = 0.15/K + ( 0.35 - L*T/(L + T)**2 )*T/(K*L)
+        ti, td = 0.35*L + 13*L*T*T/(T*T + 12*L*T + 7*L*L), 0
+    else:
+        kp = ( 0.2 + 0.45*T/L )/K
+        ti, td = ( 0.4*L + 0.8*T )/( L + 0.1*T )*L, 0.5*L*T/( 0.3*L + T )
+    return kp, kp/ti, kp*td
+
+def tuning( m, kind='PID' ):
+    return { 'Ziegler-Nichols': ziegler_nichols( m, kind ),
+             'Cohen-Coon': cohen_coon( m, kind ),
+             'AMIGO': amigo( m, kind ) }
+
+def print_tuning( m, kind='PID' ):
+    print "# model", " ".join( "%s=%g" % kv for kv in zip( m._fields, m ) )
+    print "# rule kp ki kd"
+    for name, ( kp, ki, kd ) in sorted( tuning( m, kind ).items() ):
+        print name, kp, ki, kd
+
+# ============================================================
+# Relay feedback experiment: ultimate gain and period
+
+class Relay( fb.Component ):
+    # RelayController with output bias +/- d; the output only switches
+    # when the error leaves the band +/- eps (hysteresis against noise)
+    def __init__( self, d=1, bias=0, eps=0 ):
+        self.relay = fb.RelayController()
+        self.d, self.bias, self.eps = d, bias, eps
+        self.sign = 1
+
+    def work( self, e ):
+        if abs( e ) > self.eps:
+            self.sign = self.relay.work( e )
+        return self.bias + self.d*self.sign
+
+def relay_autotune( setpoint, plant, d=1, bias=0, eps=0, tm=5000, tol=0.02,
+                    inverted=False, actuator=fb.Identity(),
+                    returnfilter=fb.Identity(), dt=None ):
+    # Closes the loop around plant with a Relay, and follows the limit
+    # cycle online: each upward switch of the relay ends a cycle. Stops
+    # as soon as period and amplitude of the last two cycles agree to
+    # within tol. Returns Ultimate( Ku, Pu, amplitude, steps ).
+
+    if not callable( setpoint ):
+        r = setpoint
+        setpoint = lambda t: r
+
+    relay = Relay( d, bias, eps )
+    dt = fb.bind( dt, [ plant, actuator, returnfilter ] )
+    records = fb.iter_closed_loop( setpoint, relay, plant, tm, inverted,
+                                   actuator, returnfilter, monitor=False,
+                                   dt=dt )
+
+    cycles = []                      # ( period, amplitude )
+    start, lo, hi, up = None, None, None, relay.sign > 0
+
+    for rec in records:
+        if start is not None:
+            lo, hi = min( lo, rec.z ), max( hi, rec.z )
+
+        if relay.sign > 0 and not up:  # upward switch: new cycle
+            if start is not None:
+                cycles.append( ( rec.t - start, 0.5*( hi - lo ) ) )
+            start, lo, hi = rec.t, rec.z, rec.z
+
+            if len( cycles ) >= 3:     # the first cycle is transient
+                ( p0, a0 ), ( p1, a1 ) = cycles[-2:]
+                if abs( p1 - p0 ) <= tol*p1 and abs( a1 - a0 ) <= tol*a1:
+                    a = max( a1, eps*(1 + 1e-9) )
+                    Ku = 4*d/( np.pi*np.sqrt( a*a - eps*eps ) )
+                    return Ultimate( Ku, p1*dt, a1, rec.t + 1 )
+
+        up = relay.sign > 0
+
+    raise RuntimeError( "No stable limit cycle within %d steps" % tm )
+
+def ultimate_tuning( u, kind='PID' ):
+    # Ziegler-Nichols rules for the ultimate gain and period: (kp, ki, kd)
+    Ku, Pu = u.Ku, u.Pu
+    if kind == 'PI':
+        kp, ti, td = 0.45*Ku, Pu/1.2, 0
+    else:
+        kp, ti, td = 0.6*Ku, Pu/2.0, Pu/8.0
+    return kp, kp/ti, kp*td
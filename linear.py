@@ -0,0 +1,154 @@
+
+import numpy as np
+import feedback as fb
+
+# Linear time-invariant systems, discretized exactly (zero-order hold on
+# the input) instead of with forward Euler steps. The discretization is
+# computed once for the sampling interval, so that it can be much larger than
+# for the Euler-integrated Boiler and Spring in feedback.py; each step is
+# then a small matrix-vector product.
+#
+#   dx/dt = A x + B u,   y = C x + D u
+#
+# With n given, the system holds a batch of n independent states, and
+# work() takes and returns arrays of shape (n,).
+
+def expm( M ):
+    # Matrix exponential: scaling and squaring, with Pade(6) approximation
+    M = np.asarray( M, dtype=float )
+    norm = np.abs( M ).sum( axis=1 ).max() if M.size else 0.0
+    s = max( 0, int( np.ceil( np.log2( norm/0.5 ) ) ) ) if norm > 0.5 else 0
+    X = M/2.0**s
+
+    c = [ 1.0, 1/2., 5/44., 1/66., 1/792., 1/15840., 1/665280. ]
+    I = np.eye( len(M) )
+    N, D, P = I.copy(), I.copy(), I.copy()
+    for k in range( 1, len(c) ):
+        P = P.dot( X )
+        N += c[k]*P
+        D += (-1)**k*c[k]*P
+
+    E = np.linalg.solve( D, N )
+    for _ in range( s ):
+        E = E.dot( E )
+    return E
+
+class LinearSystem( fb.Component ):
+    def __init__( self, A, B, C, D=0, n=None, x0=None ):
+        self.A = np.atleast_2d( np.asarray( A, dtype=float ) )
+        k = len( self.A )
+        B = np.asarray( B, dtype=float )
+        C = np.asarray( C, dtype=float )
+        if k == 0:            # no states: B is (0, inputs), C (outputs, 0)
+            self.B, self.C = B.reshape( 0, B.shape[-1] ), C.reshape( len(C), 0 )
+        else:
+            self.B, self.C = B.reshape( k, -1 ), C.reshape( -1, k )
+        D = np.asarray( D, dtype=float )
+        if D.ndim == 0:
+            D = D*np.ones( (len(self.C), self.B.shape[1]) )
+        self.D = D.reshape( len(self.C), -1 )
+
+        self.siso = self.B.shape[1] == 1 and len(self.C) == 1
+        self.n = n
+
+        shape = (k,) if n is None else (n, k)
+        self.x = np.zeros( shape )
+        if x0 is not None:
+            self.x += x0
+
+        self.discretized = None # dt of the current discretization
+
+    def discretize( self, dt ):
+        k, m = self.B.shape
+        M = np.zeros( (k+m, k+m) )
+        M[:k,:k] = self.A*dt
+        M[:k,k:] = self.B*dt
+
+        E = expm( M )
+        self.Ad, self.Bd = E[:k,:k], E[:k,k:]
+        self.discretized = dt
+
+        # Scalar systems: plain floats are faster than 1x1 arrays
+        self.scalar = k == 1 and self.siso and self.n is None
+        if self.scalar:
+            self.a, self.b = float(self.Ad[0,0]), float(self.Bd[0,0])
+            self.c, self.d = float(self.C[0,0]), float(self.D[0,0])
+            self.x = float( np.asarray( self.x ).ravel()[0] )
+
+    def work( self, u ):
+        if self.discretized != self.dt:
+            self.discretize( self.dt )
+
+        if self.scalar:
+            self.x = self.a*self.x + self.b*u
+            return self.c*self.x + self.d*u
+
+        if self.siso:
+            u = np.asarray( u, dtype=float )[...,np.newaxis]
+        else:
+            u = np.asarray( u, dtype=float )
+
+        self.x = self.x.dot( self.Ad.T ) + u.dot( self.Bd.T )
+        y = self.x.dot( self.C.T ) + u.dot( self.D.T )
+
+        if self.siso:
+            y = y[...,0]
+            if self.n is None: return float( y )
+        return y
+
+    def state( self ):
+        return np.asarray( self.x )
+
+def transfer_function( num, den, n=None ):
+    # System with transfer function num(s)/den(s), given as polynomial
+    # coefficients, highest power first (controllable canonical form)
+    num = np.trim_zeros( np.atleast_1d( np.asarray( num, dtype=float ) ), 'f' )
+    den = np.trim_zeros( np.atleast_1d( np.asarray( den, dtype=float ) ), 'f' )
+    num, den = num/den[0], den/den[0]
+
+    k = len(den) - 1
+    if len(num) > len(den):
+        raise ValueError( "Transfer function must be proper" )
+    num = np.concatenate( [ np.zeros( len(den) - len(num) ), num ] )
+
+    d = num[0]                    # direct feedthrough
+    b = num[1:] - d*den[1:]
+
+    A = np.zeros( (k, k) )
+    if k == 0:                    # static gain: feedthrough only
+        return LinearSystem( A, np.zeros( (0, 1) ), np.zeros( (1, 0) ), d, n )
+    A[0,:] = -den[1:]
+    A[1:,:-1] = np.eye( k-1 )
+    B = np.zeros( (k, 1) ); B[0,0] = 1
+    C = b.reshape( 1, k )
+
+    return LinearSystem( A, B, C, d, n )
+
+# ============================================================
+# The simple systems of feedback.py
+
+def boiler( g=0.01, n=None ):
+    # Same as fb.Boiler: dy/dt = -g y + u
+    return LinearSystem( [[-g]], [[1]], [[1]], 0, n )
+
+def spring( m=0.1, k=1, g=0.05, n=None ):
+    # Same as fb.Spring: m x'' = -k x - g x' + u; output is position x
+    return LinearSystem( [[0, 1], [-float(k)/m, -float(g)/m]],
+                         [[0], [1.0/m]], [[1, 0]], 0, n )
+
+# ============================================================
+
+if __name__ == '__main__':
+
+    # Spring step response: Euler at DT=0.001 against exact at DT=0.1
+
+    def setpoint( t ): return 1
+
+    fb.DT = 0.001
+    p = fb.Spring()
+    euler = [ rec.y for rec in fb.iter_step_response( setpoint, p, 20000 ) ]
+
+    fb.DT = 0.1
+    p = spring()
+    for rec in fb.iter_step_response( setpoint, p, 200 ):
+        print rec.time, rec.y, euler[ 100*rec.t + 99 ]
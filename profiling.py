@@ -0,0 +1,209 @@
+
+import sys
+import types
+import timeit
+import feedback as fb
+
+# Opt-in profiling for the loop functions: the setpoint, each component
+# (and components or functions nested inside them, such as the filter or
+# the demand function of a cache), monitoring and output are wrapped so
+# that calls are counted and wall time is accumulated per stage.
+#
+# The wrappers are only in place on every sample-th step (they are
+# swapped in and out by the setpoint wrapper, which runs first in each
+# step); calls and time are counted on those steps, and scaled up. Other
+# steps run the plain components, so the overhead stays small.
+#
+#   prof = profiling.closed_loop( setpoint, c, p, 100000, sample=10 )
+#   prof.report()
+#   prof.collapsed( "loop.folded" )  # input for flamegraph.pl
+
+clock = timeit.default_timer
+
+class Node:
+    def __init__( self, path ):
+        self.path = path     # tuple of stage names, outermost first
+        self.calls = 0
+        self.time = 0.0      # sampled time
+
+class Profiler:
+    def __init__( self, name, sample=10 ):
+        self.name = name
+        self.sample = sample
+        self.timing = True   # wrappers in place in the current step?
+
+        self.nodes = []
+        self.patched = []    # (object, attribute, original, wrapper)
+        self.total = 0.0
+
+    def step( self, t ):
+        timing = ( t % self.sample == 0 )
+        if timing == self.timing:
+            return
+
+        for obj, attr, original, wrapper in self.patched:
+            if timing:
+                setattr( obj, attr, wrapper )
+            else:
+                self._unpatch( obj, attr, original )
+        self.timing = timing
+
+    def wrap( self, path, fn ):
+        node = Node( path )
+        self.nodes.append( node )
+
+        def wrapper( *args ):
+            node.calls += 1
+            start = clock()
+            try:
+                return fn( *args )
+            finally:
+                node.time += clock() - start
+
+        return wrapper
+
+    def instrument( self, obj, path, seen=None ):
+        # Wrap obj.work and obj.monitoring, and recurse into attributes
+        # that are components or plain functions
+        if seen is None: seen = set()
+        if id(obj) in seen: return obj
+        seen.add( id(obj) )
+
+        attrs = sorted( vars( obj ).items() )
+
+        self._patch( obj, 'work', path )
+        if path == ( self.name, 'plant' ):
+            self._patch( obj, 'monitoring', ( self.name, 'monitoring' ) )
+
+        for attr, value in attrs:
+            if isinstance( value, fb.Component ):
+                name = "%s:%s" % ( attr, value.__class__.__name__ )
+                self.instrument( value, path + ( name, ), seen )
+            elif isinstance( value, types.FunctionType ):
+                self._patch( obj, attr, path + ( attr, ) )
+
+        return obj
+
+    def _patch( self, obj, attr, path ):
+        wrapper = self.wrap( path, getattr( obj, attr ) )
+        self.patched.append( ( obj, attr, obj.__dict__.get( attr ), wrapper ) )
+        setattr( obj, attr, wrapper )
+
+    def _unpatch( self, obj, attr, original ):
+        if original is None:                 # a method of the class
+            obj.__dict__.pop( attr, None )
+        else:
+            setattr( obj, attr, original )
+
+    def restore( self ):
+        for obj, attr, original, _ in reversed( self.patched ):
+            self._unpatch( obj, attr, original )
+        self.patched = []
+
+    def run( self, records, sink ):
+        write = self.wrap( ( self.name, 'output' ), sink.write )
+
+        start = clock()
+        try:
+            for rec in records:
+                if self.timing: # still the step of the record
+                    write( rec )
+                else:
+                    sink.write( rec )
+            sink.close()
+        finally:
+            self.total = clock() - start
+            self.restore()
+
+        return self
+
+    # --- Results
+
+    def estimate( self, node ):
+        return node.time*self.sample # sampled time, scaled to all steps
+
+    def calls( self, node ):
+        return node.calls*self.sample # sampled calls, scaled to all steps
+
+    def own( self, node ):
+        # Time spent in node itself, not in the nodes nested inside it
+        n = len( node.path )
+        inner = sum( self.estimate(c) for c in self.nodes
+                     if len(c.path) == n+1 and c.path[:n] == node.path )
+        return max( 0.0, self.estimate( node ) - inner )
+
+    def report( self, f=sys.stdout ):
+        stages = sum( self.estimate(n) for n in self.nodes if len(n.path) == 2 )
+
+        f.write( "# stage calls time_s percent us_per_call\n" )
+        for node in sorted( self.nodes, key=lambda n: n.path ):
+            est = self.estimate( node )
+            per = 1e6*node.time/node.calls if node.calls else 0.0
+            f.write( "%s%s %d %.4f %.1f %.2f\n" % (
+                "  "*( len(node.path) - 2 ), node.path[-1], self.calls( node ),
+                est, 100*est/self.total, per ) )
+        rest = self.total - stages # loop function itself
+        f.write( "(loop) - %.4f %.1f -\n" % ( rest, 100*rest/self.total ) )
+        f.write( "(total) - %.4f 100.0 -\n" % self.total )
+
+    def collapsed( self, filename ):
+        # One line per stack: frames separated by ';', then microseconds
+        stages = sum( self.estimate(n) for n in self.nodes if len(n.path) == 2 )
+
+        f = open( filename, 'w' )
+        f.write( "%s %d\n" % ( self.name, 1e6*( self.total - stages ) ) )
+        for node in self.nodes:
+            f.write( "%s %d\n" % ( ";".join( node.path ), 1e6*self.own( node ) ) )
+        f.close()
+
+# ============================================================
+# Loop functions
+
+def _components( prof, components ):
+    # components: list of (stage name, component or None)
+    for stage, c in components:
+        if c is not None:
+            prof.instrument( c, ( prof.name, stage ) )
+
+def _setpoint( prof, setpoint ):
+    # Always in place: switches the other wrappers at the start of a step
+    stage = prof.wrap( ( prof.name, 'setpoint' ), setpoint )
+    def wrapper( t ):
+        prof.step( t )
+        if prof.timing:
+            return stage( t )
+        return setpoint( t )
+    return wrapper
+
+def step_response( setpoint, plant, tm=5000, sink=None, sample=10, dt=None ):
+    prof = Profiler( 'step_response', sample )
+    _components( prof, [ ( 'plant', plant ) ] )
+
+    records = fb.iter_step_response( _setpoint( prof, setpoint ), plant, tm,
+                                     dt=dt )
+    return prof.run( records, sink or fb.NullSink() )
+
+def open_loop( setpoint, controller, plant, tm=5000, sink=None, sample=10,
+               dt=None ):
+    prof = Profiler( 'open_loop', sample )
+    _components( prof, [ ( 'controller', controller ), ( 'plant', plant ) ] )
+
+    records = fb.iter_open_loop( _setpoint( prof, setpoint ),
+                                 controller, plant, tm, dt=dt )
+    return prof.run( records, sink or fb.NullSink() )
+
+def closed_loop( setpoint, controller, plant, tm=5000, inverted=False,
+                 actuator=None, returnfilter=None, sink=None, sample=10,
+                 dt=None ):
+    # Fresh Identity blocks: the shared defaults must not be instrumented
+    actuator = actuator or fb.Identity()
+    returnfilter = returnfilter or fb.Identity()
+
+    prof = Profiler( 'closed_loop', sample )
+    _components( prof, [ ( 'controller', controller ), ( 'actuator', actuator ),
+                         ( 'plant', plant ), ( 'returnfilter', returnfilter ) ] )
+
+    records = fb.iter_closed_loop( _setpoint( prof, setpoint ), controller,
+                                   plant, tm, inverted, actuator, returnfilter,
+                                   dt=dt )
+    return prof.run( records, sink or fb.NullSink() )
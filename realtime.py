@@ -0,0 +1,177 @@
+
+import time
+import math
+import heapq
+import feedback as fb
+
+# Real-time loop runner: drives controllers against live systems at
+# wall-clock rate. Many loops share one scheduler (a single-threaded event
+# loop), which sleeps until the next loop is due, runs its tick, and keeps
+# track of tick latency, jitter and missed deadlines.
+#
+# Sensors and actuators are adapters with read() and write(u) methods.
+# They share the event loop, so they must return promptly: anything slow
+# (network, device I/O) belongs behind a buffer that the adapter polls.
+
+# ============================================================
+# Adapters
+
+# The base classes are a loopback: read() returns the last value passed to
+# write() (0 before the first write), so an adapter that is both needs only
+# to overload the side it talks to
+
+class Sensor:
+    value = 0
+
+    def read( self ):
+        return self.value
+
+class Actuator:
+    value = 0
+
+    def write( self, u ):
+        self.value = u
+
+class SimulatedPlant( Sensor, Actuator ):
+    # Local stand-in for a live system: the plant is advanced in steps of
+    # DT according to the wall-clock time that has passed, using the most
+    # recent actuator setting. y: output until the plant has run a step
+
+    def __init__( self, plant, clock=time.time, dt=None, y=0 ):
+        self.dt = fb.bind( dt, [ plant ] )
+        self.plant = plant
+        self.clock = clock
+
+        self.u = 0
+        self.y = y
+        self.last = None     # wall-clock time up to which plant has run
+
+    def write( self, u ):
+        self._advance()
+        self.u = u
+
+    def read( self ):
+        self._advance()
+        return self.y
+
+    def _advance( self ):
+        now = self.clock()
+        if self.last is None:
+            self.last = now
+
+        while now - self.last >= self.dt:
+            self.y = self.plant.work( self.u )
+            self.last += self.dt
+
+# ============================================================
+# Loops
+
+class Stats:
+    def __init__( self ):
+        self.ticks = 0
+        self.missed = 0      # ticks that could not run before the next one
+        self.sum = 0.0       # sum and sum of squares of latency
+        self.sumsq = 0.0
+        self.max = 0.0
+
+    def add( self, latency ):
+        self.ticks += 1
+        self.sum += latency
+        self.sumsq += latency*latency
+        self.max = max( self.max, latency )
+
+    def mean( self ):
+        if self.ticks == 0: return 0.0
+        return self.sum/self.ticks
+
+    def jitter( self ):      # standard deviation of the latency
+        if self.ticks == 0: return 0.0
+        m = self.mean()
+        return math.sqrt( max( 0.0, self.sumsq/self.ticks - m*m ) )
+
+class Loop:
+    def __init__( self, name, setpoint, controller, sensor, actuator,
+                  dt=None, inverted=False, returnfilter=fb.Identity(),
+                  sink=None ):
+        self.name = name
+        self.setpoint = setpoint
+        self.controller = controller
+        self.sensor = sensor
+        self.actuator = actuator
+        self.returnfilter = returnfilter
+        self.inverted = inverted
+        self.sink = sink     # receives a fb.Step record per tick, if set
+
+        self.dt = fb.bind( dt, [ controller, returnfilter ] )
+        self.t = 0           # tick counter
+        self.stats = Stats()
+
+    def tick( self, now ):
+        y = self.sensor.read()
+        z = self.returnfilter.work( y )
+
+        r = self.setpoint( self.t )
+        e = r - z
+        if self.inverted == True: e = -e
+        u = self.controller.work( e )
+        self.actuator.write( u )
+
+        if self.sink is not None:
+            self.sink.write( fb.Step( self.t, now, r, e, u, u, y, z, "" ) )
+        self.t += 1
+
+# ============================================================
+# Scheduler
+
+class Scheduler:
+    def __init__( self, clock=time.time, sleep=time.sleep ):
+        self.clock = clock
+        self.sleep = sleep
+        self.queue = []      # heap of (deadline, sequence number, loop)
+        self.seq = 0
+        self.loops = []
+
+    def add( self, loop, start=None ):
+        if start is None:
+            start = self.clock()
+        self.loops.append( loop )
+        self._push( start, loop )
+
+    def _push( self, deadline, loop ):
+        heapq.heappush( self.queue, ( deadline, self.seq, loop ) )
+        self.seq += 1
+
+    def run( self, duration ):
+        end = self.clock() + duration
+
+        while self.queue:
+            deadline, _, loop = heapq.heappop( self.queue )
+            if deadline > end:
+                self._push( deadline, loop ) # keep for next run()
+                break
+
+            wait = deadline - self.clock()
+            if wait > 0:
+                self.sleep( wait )
+
+            start = self.clock()
+            loop.stats.add( start - deadline )
+            loop.tick( start )
+
+            # Next deadline; ticks whose time has already passed are skipped
+            deadline += loop.dt
+            now = self.clock()
+            if now > deadline:
+                late = int( (now - deadline)/loop.dt ) + 1
+                loop.stats.missed += late
+                loop.t += late
+                deadline += late*loop.dt
+
+            self._push( deadline, loop )
+
+    def report( self ):
+        print "# loop ticks missed mean_latency max_latency jitter (ms)"
+        for loop in self.loops:
+            s = loop.stats
+            print loop.name, s.ticks, s.missed,
+            print "%.3f %.3f %.3f" % ( 1e3*s.mean(), 1e3*s.max, 1e3*s.jitter() )
@@ -0,0 +1,119 @@
+
+import sys
+import math
+import random
+import itertools
+import multiprocessing
+import feedback as fb
+
+# Gain sweeps: run a scenario for many (kp, ki, kd) combinations in a
+# process pool and rank them by cost. A scenario is a function of the
+# gains that returns step records, for example:
+#
+#   def scenario( kp, ki, kd ):
+#       p = Plant(); c = fb.PidController( kp, ki, kd )
+#       return fb.iter_closed_loop( setpoint, c, p, monitor=False )
+#
+# Costs are accumulated while the run progresses; no traces are stored.
+
+# ============================================================
+# Cost metrics
+
+METRICS = ( 'iae', 'ise', 'itae', 'overshoot', 'effort' )
+
+class Costs:
+    def __init__( self, dt=None ):
+        self.dt = fb.DT if dt is None else dt
+
+        self.iae = 0.0       # integral of absolute error
+        self.ise = 0.0       # integral of squared error
+        self.itae = 0.0      # integral of time-weighted absolute error
+        self.overshoot = 0.0 # largest overshoot, relative to setpoint change
+        self.effort = 0.0    # integral of squared control action
+
+        self.r = 0           # current setpoint, and size of its last change
+        self.change = 0
+
+    def add( self, rec ):
+        e = abs( rec.e )
+        self.iae += self.dt*e
+        self.ise += self.dt*e*e
+        self.itae += self.dt*rec.time*e
+        self.effort += self.dt*rec.u*rec.u
+
+        if rec.r != self.r:
+            self.change = rec.r - self.r
+            self.r = rec.r
+
+        if self.change != 0:
+            over = ( rec.z - rec.r )/float( self.change )
+            self.overshoot = max( self.overshoot, over )
+
+    def result( self ):
+        return dict( (m, getattr( self, m )) for m in METRICS )
+
+def costs( records, dt=None ):
+    c = Costs( dt )
+    for rec in records:
+        c.add( rec )
+    return c.result()
+
+# ============================================================
+# Gain sets
+
+def grid( kps, kis, kds=(0,) ):
+    return list( itertools.product( kps, kis, kds ) )
+
+def sample( n, kp, ki, kd=(0,0), seed=None ):
+    # n random gain sets, uniform within the ranges kp=(lo,hi) etc
+    rnd = random.Random( seed )
+    return [ ( rnd.uniform( *kp ), rnd.uniform( *ki ), rnd.uniform( *kd ) )
+             for _ in range( n ) ]
+
+# ============================================================
+# Sweep
+
+def sweep( scenario, gains, key='iae', processes=None, seed=None, dt=None ):
+    # Returns a list of (gains, costs) pairs, best first according to key
+
+    global _scenario
+    _scenario = ( scenario, seed, dt )
+
+    pool = multiprocessing.Pool( processes ) # fork: scenario is inherited
+    try:
+        results = pool.map( _run, enumerate( gains ), chunksize=4 )
+    finally:
+        pool.terminate()
+        _scenario = None
+
+    def rank( item ):
+        v = item[1][key]
+        if math.isnan( v ): return float( 'inf' ) # diverged runs go last
+        return v
+
+    return sorted( zip( gains, results ), key=rank )
+
+def print_table( results, top=None ):
+    print "# rank kp ki kd", " ".join( METRICS )
+    for i, ( (kp, ki, kd), c ) in enumerate( results[:top] ):
+        print i+1, kp, ki, kd, " ".join( "%g" % c[m] for m in METRICS )
+
+_scenario = None
+
+def _run( task ):
+    k, gains = task
+    scenario, seed, dt = _scenario
+
+    np = sys.modules.get( 'numpy' ) # reseeded too, if the scenario uses it
+
+    if seed is None:             # forked workers must not share RNG state
+        random.seed()
+        if np: np.random.seed()
+    else:
+        random.seed( seed*1000003 + k )
+        if np: np.random.seed( [ seed, k ] )
+
+    try:
+        return costs( scenario( *gains ), dt )
+    except ( OverflowError, ZeroDivisionError, ValueError ):
+        return dict( (m, float( 'inf' )) for m in METRICS ) # diverged
@@ -0,0 +1,203 @@
+
+import os
+import time
+import struct
+import numpy as np
+import feedback as fb
+
+# Binary trajectories: a sink that stores each column of the step records
+# (t, time, r, e, u, v, y, z, and the fields of the monitoring string) as
+# a .npy file of its own in a directory. Records are buffered and written
+# in chunks; the array headers have a fixed size, and get the final
+# lengths when the sink is closed. Columns are read back as memory-mapped
+# arrays, without parsing.
+#
+#   production( sink=trajectory.TrajectorySink( "production.traj", every=10 ) )
+#   tr = trajectory.load( "production.traj" )
+#   print tr.time[-1], tr.y.mean()
+#
+# Decimation: every=k keeps every k-th record; bucket=k keeps the minimum
+# and the maximum of each column for each bucket of k records (two values
+# per bucket, for plotting: the time columns then hold the first and the
+# last step of the bucket). Values are stored as float32 by default (the
+# t and time columns stay exact); pass dtype=np.float64 for full precision.
+#
+# Size against text, for 100000 steps of the boiler loop (the benchmark
+# below): text 6.5 MB; float64 6.4 MB; float32 4.0 MB; every=10 0.40 MB;
+# bucket=100 0.08 MB. Full resolution saves less than a factor of two:
+# an order of magnitude takes decimation. Writing costs about the same
+# as text; reading back needs no parsing.
+
+MAGIC = '\x93NUMPY\x01\x00'
+HEADER = 128      # bytes: magic, header length, and the padded dict
+
+def _header( dtype, n ):
+    d = "{'descr': '%s', 'fortran_order': False, 'shape': (%d,), }" % (
+        np.dtype( dtype ).str, n )
+    return MAGIC + struct.pack( '<H', HEADER - 10 ) + d.ljust( HEADER - 11 ) + '\n'
+
+class Column:
+    # One .npy file, appended to in chunks
+    def __init__( self, filename, dtype ):
+        self.f = open( filename, 'wb' )
+        self.dtype = dtype
+        self.n = 0
+        self.f.write( _header( dtype, 0 ) )
+
+    def append( self, x ):
+        x = np.asarray( x, dtype=self.dtype )
+        self.f.write( x.tostring() )
+        self.n += len( x )
+
+    def close( self ):
+        self.f.seek( 0 )
+        self.f.write( _header( self.dtype, self.n ) )
+        self.f.close()
+
+class TrajectorySink:
+    # Sink for the loop functions (their sink argument, or fb.drain).
+    # monitoring: names for the fields of the monitoring string (default
+    # m0, m1, ...)
+
+    def __init__( self, directory, every=1, bucket=None, chunk=65536,
+                  monitoring=None, dtype=np.float32 ):
+        if every > 1 and bucket:
+            raise ValueError( "Use either every or bucket, not both" )
+        if not os.path.isdir( directory ):
+            os.makedirs( directory )
+
+        self.directory = directory
+        self.every, self.bucket = every, bucket
+        k = bucket or every
+        self.chunk = max( 1, chunk//k )*k  # whole buckets in each chunk
+        self.monitoring = monitoring
+        self.dtype = dtype
+
+        self.rows = []
+        self.columns = None
+
+    def open( self, rec ):
+        self.fields = list( rec._fields )
+        self.split = 'monitoring' in self.fields  # string, to split up
+        if self.split:
+            self.mindex = self.fields.index( 'monitoring' )
+            self.fields.remove( 'monitoring' )
+            m = len( rec.monitoring.split() )
+            self.fields += self.monitoring or [ "m%d" % i for i in range( m ) ]
+
+        types = { 't': np.int64, 'time': np.float64 } # exact, as in the text
+        self.columns = [ Column( os.path.join( self.directory, f + '.npy' ),
+                                 types.get( f, self.dtype ) )
+                         for f in self.fields ]
+
+        index = open( os.path.join( self.directory, 'columns' ), 'w' )
+        index.write( "\n".join( self.fields ) + "\n" )
+        index.close()
+
+    def write( self, rec ):
+        if self.columns is None:
+            self.open( rec )
+
+        self.rows.append( rec )
+        if len( self.rows ) == self.chunk:
+            self.flush()
+
+    def flush( self ):
+        if not self.rows: return
+
+        values = zip( *self.rows )
+        if self.split:     # all monitoring strings parsed in one go
+            monitoring = values.pop( self.mindex )
+            m = len( self.fields ) - len( values )
+            fields = np.array( " ".join( monitoring ).split(), dtype=float )
+            values += list( fields.reshape( len( self.rows ), m ).T )
+        self.rows = []
+
+        for c, x in zip( self.columns, values ):
+            c.append( self.decimate( np.asarray( x, dtype=c.dtype ) ) )
+
+    def decimate( self, x ):
+        # Chunks hold whole buckets; only the last one may be partial
+        if self.bucket:
+            starts = np.arange( 0, len(x), self.bucket )
+            lo = np.minimum.reduceat( x, starts )
+            hi = np.maximum.reduceat( x, starts )
+            return np.column_stack( [ lo, hi ] ).ravel()
+
+        return x[::self.every]
+
+    def close( self ):
+        if self.columns is None: return
+        self.flush()
+        for c in self.columns:
+            c.close()
+
+# ============================================================
+# Loading
+
+class Trajectory:
+    # Columns of a stored trajectory, as read-only memory-mapped arrays:
+    # tr.y, or tr['y']; tr.fields lists them in order
+    def __init__( self, directory ):
+        self.fields = open( os.path.join( directory, 'columns' ) ).read().split()
+        for f in self.fields:
+            setattr( self, f, _map( os.path.join( directory, f + '.npy' ) ) )
+
+    def __getitem__( self, field ):
+        return getattr( self, field )
+
+    def __len__( self ):
+        return len( getattr( self, self.fields[0] ) )
+
+    def rows( self ):
+        # Records as tuples, in the order of the columns (like the text)
+        return zip( *[ getattr( self, f ) for f in self.fields ] )
+
+def _map( filename ):
+    if os.path.getsize( filename ) == HEADER:  # empty: nothing to map
+        return np.load( filename )
+    return np.load( filename, mmap_mode='r' )
+
+def load( directory ):
+    return Trajectory( directory )
+
+# ============================================================
+
+if __name__ == '__main__':
+
+    # Text lines against binary columns, for a long closed loop run
+
+    def setpoint( t ):
+        return 10*fb.double_step( t, 10000, 60000 )
+
+    def run( sink ):
+        p = fb.Boiler()
+        c = fb.PidController( 0.45, 0.01 )
+        start = time.time()
+        fb.drain( fb.iter_closed_loop( setpoint, c, p, 100000, dt=1 ), sink )
+        return time.time() - start
+
+    def size( path ):
+        if not os.path.exists( path ): return 0
+        if os.path.isfile( path ): return os.path.getsize( path )
+        return sum( os.path.getsize( os.path.join( path, f ) )
+                    for f in os.listdir( path ) )
+
+    d = "/tmp/trajectory-%d" % os.getpid()
+    os.makedirs( d )
+
+    print "# output seconds bytes"
+    for name, sink, path in [
+        ( "none", lambda f: fb.NullSink(), "none" ),
+        ( "text", lambda f: fb.FileSink( f ), "text.dat" ),
+        ( "float64", lambda f: TrajectorySink( f, dtype=np.float64 ),
+          "float64.traj" ),
+        ( "binary", lambda f: TrajectorySink( f ), "binary.traj" ),
+        ( "every10", lambda f: TrajectorySink( f, every=10 ), "every10.traj" ),
+        ( "bucket100", lambda f: TrajectorySink( f, bucket=100 ),
+          "bucket100.traj" ) ]:
+        path = os.path.join( d, path )
+        print name, run( sink( path ) ), size( path )
+
+    tr = load( os.path.join( d, "binary.traj" ) )
+    print "# loaded", len( tr ), "steps:", " ".join( tr.fields )